@@ -2,15 +2,43 @@
 Script to download Github archive data and load them into PostgreSQL
 """
 import argparse
-import gzip
+import io
+import itertools
 import os
-import json
-import random
+import re
+import multiprocessing
+import queue
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import sys
 import requests
 import psycopg2
 import yaml
+from gharchive_stream import decompressor_backend, iter_gzip_lines, open_archive_chunks
+from gharchive_prefetch import HourPrefetcher, remote_size
+from gharchive_cache import ArchiveCache
+from gharchive_common import prepare_runtime_file
+from gharchive_events import JSON_LIBRARY, build_transform, event_type
+from gharchive_transform import TransformPool, serialize_lines, sort_rows
+from gharchive_pipeline import LoadPipeline
+from gharchive_compact import expand_function_sql
+from gharchive_dedup import EventIdFilter
+
+RUNTIME_FILE_HEADER = ('file_name,unix_timestamp,loop_start,loop_end,runtime,total_run_time_seconds,'
+                       'relation_size,table_size,index_size,rows_inserted,rows_per_second,errors,load_mode,'
+                       'decompressor,decompress_mb_per_second,duplicates\n')
+
+# lock serializing writes of parallel workers into the runtime file
+RUNTIME_FILE_LOCK = None
+
+# connection and helpers of worker process, set by init_worker
+WORKER = {}
+
+# suspected duplicates are skipped by unique index on event id
+DEDUP_CONFLICT = " ON CONFLICT ((jsonb_data->>'id')) DO NOTHING"
 
 def read_yaml(filename):
     """
@@ -95,6 +123,24 @@ def parse_input():
         action='store_true',
         help='If set script will run GIN inspection script after each insert')
 
+    parser.add_argument(
+        '--gin_inspection_every_rows',
+        type=int,
+        default=0,
+        help='GIN inspection after insert: inspect only after this many rows since the last inspection')
+
+    parser.add_argument(
+        '--gin_inspection_every_seconds',
+        type=float,
+        default=0,
+        help='GIN inspection after insert: inspect only after this many seconds since the last inspection')
+
+    parser.add_argument(
+        '--gin_inspection_flush',
+        type=int,
+        default=10,
+        help='GIN inspection results are committed after this many inspections')
+
     parser.add_argument(
         '-d',
         '--debug',
@@ -117,62 +163,1108 @@ def parse_input():
         '-rd',
         '--random_drop',
         action='store_true',
-        help='If set script drops randomly from 1 to 3 keys in each row')
+        help='If set script drops random keys in each row, see random_drop_* options')
+
+    parser.add_argument(
+        '--random_drop_seed',
+        type=int,
+        help='Random drop: seed making dropped keys reproducible between runs')
+
+    parser.add_argument(
+        '--random_drop_keys',
+        nargs='+',
+        help='Random drop: keys which can be dropped, all keys if not set')
+
+    parser.add_argument(
+        '--random_drop_min',
+        type=int,
+        default=1,
+        help='Random drop: minimal number of keys dropped from each event')
+
+    parser.add_argument(
+        '--random_drop_max',
+        type=int,
+        default=3,
+        help='Random drop: maximal number of keys dropped from each event')
+
+    parser.add_argument(
+        '--random_drop_depth',
+        type=int,
+        default=1,
+        help='Random drop: keys of nested objects up to this depth can be dropped, 1 means top level keys only')
+
+    parser.add_argument(
+        '-cp',
+        '--copy',
+        action='store_true',
+        help='If set script loads rows in batches with COPY FROM STDIN instead of one INSERT per row')
+
+    parser.add_argument(
+        '--batch_rows',
+        type=int,
+        default=5000,
+        help='COPY mode: maximal number of rows sent in one COPY batch')
+
+    parser.add_argument(
+        '--batch_bytes',
+        type=int,
+        default=16 * 1024 * 1024,
+        help='COPY mode: maximal number of bytes sent in one COPY batch')
+
+    parser.add_argument(
+        '--commit_rows',
+        type=int,
+        default=0,
+        help='COPY mode: commit after this many rows, 0 means commit after each batch')
+
+    parser.add_argument(
+        '--commit_bytes',
+        type=int,
+        default=0,
+        help='COPY mode: commit after this many bytes, 0 means commit after each batch')
+
+    parser.add_argument(
+        '-st',
+        '--stream',
+        action='store_true',
+        help='If set script decompresses and loads data while downloading instead of storing file in /tmp')
+
+    parser.add_argument(
+        '-pf',
+        '--prefetch',
+        type=int,
+        default=0,
+        help='Number of next hours downloaded concurrently while the current hour is loaded, 0 disables prefetch')
+
+    parser.add_argument(
+        '--prefetch_disk_budget',
+        type=int,
+        default=2048,
+        help='Prefetch: maximal size in MB of downloaded files waiting for load')
+
+    parser.add_argument(
+        '-cd',
+        '--cache_dir',
+        required=False,
+        help='Directory for persistent cache of downloaded files, files are kept there and reused by next runs')
+
+    parser.add_argument(
+        '--cache_max_size',
+        type=int,
+        default=20480,
+        help='Cache: maximal size of cache directory in MB, least recently used files are evicted, 0 means unlimited')
+
+    parser.add_argument(
+        '-mt',
+        '--manifest_table',
+        required=False,
+        help='Table for load manifest, completed hours are skipped and interrupted hour is resumed from the last commit')
+
+    parser.add_argument(
+        '-cpt',
+        '--create_partitions',
+        action='store_true',
+        help='For RANGE partitioned table load each day into new standalone table with COPY (FREEZE), '
+             'build indexes and attach it as partition when the day is loaded. The hour which creates the table '
+             'is committed only at its end, commit interval and manifest checkpoints apply to next hours')
+
+    parser.add_argument(
+        '-w',
+        '--workers',
+        type=int,
+        default=1,
+        help='Number of worker processes loading hours (days with --create_partitions) in parallel, '
+             'each worker uses its own connection')
+
+    parser.add_argument(
+        '-di',
+        '--defer_indexes',
+        action='store_true',
+        help='If set indexes of the table (except primary key and unique ones) are dropped before load '
+             'and built again after the whole range is loaded, also on its partitions and route tables')
+
+    parser.add_argument(
+        '--index_build_workers',
+        type=int,
+        default=4,
+        help='Deferred indexes: max_parallel_maintenance_workers used for index build')
+
+    parser.add_argument(
+        '--maintenance_work_mem',
+        default='1GB',
+        help='Deferred indexes: maintenance_work_mem used for index build')
+
+    parser.add_argument(
+        '-tw',
+        '--transform_workers',
+        type=int,
+        default=0,
+        help='Number of processes parsing and transforming lines, 0 means lines are processed by the loader process')
+
+    parser.add_argument(
+        '--transform_chunk_lines',
+        type=int,
+        default=10000,
+        help='Transform workers: number of lines sent to worker process in one chunk')
+
+    parser.add_argument(
+        '--transform_unordered',
+        action='store_true',
+        help='Transform workers: rows are loaded in order of finished chunks instead of order of lines in the file')
+
+    parser.add_argument(
+        '-pl',
+        '--pipeline',
+        action='store_true',
+        help='If set reading, decompression and transformation of lines run as separate stages in threads '
+             'connected by bounded queues, in parallel with database writes')
+
+    parser.add_argument(
+        '--pipeline_memory',
+        type=int,
+        default=512,
+        help='Pipeline: memory budget in MB for data waiting in queues between stages')
+
+    parser.add_argument(
+        '-dc',
+        '--decompressor',
+        default='auto',
+        choices=['auto', 'zlib', 'isal', 'zlib_ng'],
+        help='Decompression backend, auto selects the fastest installed one (isal, zlib_ng, zlib)')
+
+    parser.add_argument(
+        '--include_types',
+        nargs='+',
+        help='Load only events of these types, e.g. PushEvent PullRequestEvent')
+
+    parser.add_argument(
+        '--include_repos',
+        nargs='+',
+        help='Load only events of these repositories, e.g. postgres/postgres')
+
+    parser.add_argument(
+        '--project',
+        nargs='+',
+        help='Store only these paths of each event, nested keys separated by dot, e.g. type repo.name payload.size')
+
+    parser.add_argument(
+        '-cu',
+        '--compact_urls',
+        action='store_true',
+        help='Remove URL fields derivable from ids and logins, view <table>_expanded with function '
+             'gharchive_expand restores them on read')
+
+    parser.add_argument(
+        '--sort_key',
+        nargs='+',
+        help='Sort rows by these paths (nested keys separated by dot) before they are written, '
+             'e.g. type repo.id created_at')
+
+    parser.add_argument(
+        '--sort_window',
+        type=int,
+        default=0,
+        help='Sort: number of rows sorted together, 0 means whole hour')
+
+    parser.add_argument(
+        '--probe_query',
+        required=False,
+        help='Query run after the load to measure query speed on loaded table, fastest run goes into runtime file')
+
+    parser.add_argument(
+        '--probe_runs',
+        type=int,
+        default=3,
+        help='Probe query: number of runs')
+
+    parser.add_argument(
+        '-dd',
+        '--dedup',
+        action='store_true',
+        help='Skip events already loaded, ids of loaded events are kept in Bloom filter file, '
+             'events suspected by the filter are checked by unique index on event id')
+
+    parser.add_argument(
+        '--dedup_filter',
+        required=False,
+        help='Dedup: Bloom filter file, default is <table_name>.event_ids.bloom')
+
+    parser.add_argument(
+        '--dedup_capacity',
+        type=int,
+        default=50000000,
+        help='Dedup: expected number of events in new filter')
+
+    parser.add_argument(
+        '--dedup_error_rate',
+        type=float,
+        default=0.001,
+        help='Dedup: false positive rate of new filter at capacity')
+
+    parser.add_argument(
+        '--dedup_save_hours',
+        type=int,
+        default=24,
+        help='Dedup: filter file is saved after this many loaded hours and at the end of the run')
+
+    parser.add_argument(
+        '-rt',
+        '--route_by_type',
+        choices=['table', 'partition'],
+        required=False,
+        help='Load each event type into its own table with its own COPY writer, tables are created when new type '
+             'appears: "table" - table inheriting the loaded table with CHECK on type and copies of its indexes, '
+             '"partition" - LIST partition of table partitioned by jsonb_data->>\'type\'')
 
     args = parser.parse_args()
 
     return args
 
-def drop_random_keys(event):
-    """
-    Drops random keys from event
-    """
-    keys = list(event.keys())
-    random.shuffle(keys)
-    num_keys_to_drop = random.randint(1, 3)
-    keys_to_drop = random.sample(keys, num_keys_to_drop)
-    for key in keys_to_drop:
-        del event[key]
-    return event
+# sizes of loaded table or partition, parameter is table name
+SIZES_QUERY = "SELECT pg_relation_size($1::regclass), pg_table_size($1::regclass), pg_indexes_size($1::regclass)"
 
 
-def inspect_gin_index(conn, cur, table_name, args, insert_commit_runtime):
+class CatalogCache:
     """
-    Inspects GIN index
+    Catalog metadata of loaded tables looked up once per run
+
+    Table kind, partitions and GIN indexes are cached per table. Cache is cleared
+    only when a partition is created or attached. Lookups are serialized by lock,
+    cache is shared with GIN inspection thread which uses its own cursor.
     """
-    print(f"  {datetime.now()}: inspect_gin_index: {table_name}") if args.debug else None
-    if args.gin_inspection_script:
+    def __init__(self, debug=False):
+        self.debug = debug
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def lookup(self, cur, kind, table_name, query):
+        """
+        Returns cached rows of the query for the table, runs the query on first use
+        """
+        with self.lock:
+            if (kind, table_name) not in self.entries:
+                print(f"  {datetime.now()}: catalog lookup {kind}: {table_name}") if self.debug else None
+                cur.execute(query, (table_name, ))
+                self.entries[(kind, table_name)] = cur.fetchall()
+            return self.entries[(kind, table_name)]
+
+    def relkind(self, cur, table_name):
+        """
+        Returns relkind of the table or None if the table does not exist
+        """
+        rows = self.lookup(cur, 'relkind', table_name, "SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)")
+        return rows[0][0] if rows else None
+
+    def partitions(self, cur, table_name):
+        """
+        Returns set of names (without schema) of partitions attached to the table
+        """
+        rows = self.lookup(cur, 'partitions', table_name,
+                           "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                           "WHERE i.inhparent = to_regclass(%s)")
+        return {row[0] for row in rows}
+
+    def gin_indexes(self, cur, table_name):
+        """
+        Returns names of GIN indexes of the table
+        """
         # find name of gin index related to the table using select from database
-        query = ("SELECT quote_ident(relnamespace::regnamespace::text)||'.'||quote_ident(relname) "
-            "FROM pg_class where relnamespace::regnamespace::text||'.'||relname IN ("
-            f"SELECT schemaname||'.'||indexname from pg_indexes WHERE schemaname||'.'||tablename = '{table_name}' "
-            "AND indexdef ilike '% using gin %')")
-        print(f"  {datetime.now()}: query: {query}") if args.debug else None
+        rows = self.lookup(cur, 'gin_indexes', table_name,
+                           "SELECT quote_ident(relnamespace::regnamespace::text)||'.'||quote_ident(relname) "
+                           "FROM pg_class where relnamespace::regnamespace::text||'.'||relname IN ("
+                           "SELECT schemaname||'.'||indexname from pg_indexes WHERE schemaname||'.'||tablename = %s "
+                           "AND indexdef ilike '%% using gin %%')")
+        return [row[0] for row in rows]
+
+    def refresh(self):
+        """
+        Forgets cached metadata, called when a partition was created or attached
+        """
+        with self.lock:
+            self.entries = {}
+
+
+class PreparedStatements:
+    """
+    Server side prepared statements of one connection
 
-        cur.execute(query)
-        rows = cur.fetchall()
+    Statement is prepared on its first use and then run with EXECUTE, so it is
+    parsed and planned once per connection instead of once per row or hour.
+    Parameters are written as $1, $2, ... in the query.
+    """
+    def __init__(self, cur):
+        self.cur = cur
+        self.names = {}
+
+    def execute(self, query, params=()):
+        """
+        Executes prepared statement for the query, prepares it if needed
+        """
+        name = self.names.get(query)
+        if name is None:
+            name = f"gh_statement_{len(self.names) + 1}"
+            self.cur.execute(f"PREPARE {name} AS {query}")
+            self.names[query] = name
+        if params:
+            self.cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+        else:
+            self.cur.execute(f"EXECUTE {name}")
+
+
+class GinInspector:
+    """
+    Inspects GIN indexes in background thread with its own connection
 
-        for row in rows:
-            gin_index_name = row[0]
-            print(f"  {datetime.now()}: gin_index_name: {gin_index_name}") if args.debug else None
+    Inspection requests after inserts are sampled by number of rows or time and
+    dropped when previous inspection is still running, so the insert loop never
+    waits. Inspection script is read once, names of GIN indexes are taken from
+    catalog cache and results are committed in bulk after gin_inspection_flush inspections.
+    """
+    def __init__(self, connection, args, catalog):
+        self.args = args
+        self.catalog = catalog
+        self.conn = open_connection(connection)
+        self.cur = self.conn.cursor()
+        self.statements = PreparedStatements(self.cur)
+        with open(args.gin_inspection_script, 'r') as file:
+            self.script = file.read()
+        self.uncommitted = 0
+        self.skipped = 0
+        self.last_row = 0
+        self.last_time = time.monotonic()
+        self.requests = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def sample(self, table_name, row, insert_commit_runtime):
+        """
+        Requests inspection after insert if sampling interval passed, never blocks
+        """
+        every_rows = self.args.gin_inspection_every_rows
+        every_seconds = self.args.gin_inspection_every_seconds
+        # without sampling every insert is inspected, otherwise whichever interval passes first
+        due = not every_rows and not every_seconds
+        if every_rows and row - self.last_row >= every_rows:
+            due = True
+        if every_seconds and time.monotonic() - self.last_time >= every_seconds:
+            due = True
+        if not due:
+            return
+        try:
+            self.requests.put_nowait((table_name, insert_commit_runtime))
+        except queue.Full:
+            self.skipped += 1
+            return
+        print(f"GIN inspection: table {table_name} after {row} rows inserted")
+        self.last_row = row
+        self.last_time = time.monotonic()
+
+    def request(self, table_name, insert_commit_runtime):
+        """
+        Requests inspection, waits for free slot in the queue
+        """
+        self.requests.put((table_name, insert_commit_runtime))
+
+    def new_file(self):
+        """
+        Resets row sampling for next file
+        """
+        self.last_row = 0
+
+    def run(self):
+        """
+        Runs requested inspections
+        """
+        while True:
+            item = self.requests.get()
+            try:
+                if item is None:
+                    self.conn.commit()
+                    return
+                if item == 'flush':
+                    self.conn.commit()
+                    self.uncommitted = 0
+                    continue
+                self.inspect(*item)
+            except Exception as error:
+                print(f" {datetime.now()}: GIN inspection failed, Error: {error}")
+                self.conn.rollback()
+            finally:
+                self.requests.task_done()
+
+    def inspect(self, table_name, insert_commit_runtime):
+        """
+        Inspects GIN indexes of the table
+        """
+        print(f"  {datetime.now()}: inspect_gin_index: {table_name}") if self.args.debug else None
+        for gin_index_name in self.catalog.gin_indexes(self.cur, table_name):
+            print(f"  {datetime.now()}: gin_index_name: {gin_index_name}") if self.args.debug else None
+            self.statements.execute("SELECT set_config('inspect_gin_index.table_name', $1, false), "
+                                    "set_config('inspect_gin_index.index_name', $2, false), "
+                                    "set_config('inspect_gin_index.result_target', 'table', false), "
+                                    "set_config('inspect_gin_index.insert_commit_runtime', $3, false)",
+                                    (table_name, gin_index_name, str(insert_commit_runtime)))
+            # inspection script has several statements, it can not be prepared
+            self.cur.execute(self.script)
+
+        self.uncommitted += 1
+        if self.uncommitted >= self.args.gin_inspection_flush:
+            self.conn.commit()
+            self.uncommitted = 0
+
+    def flush(self):
+        """
+        Waits for requested inspections and commits their results
+        """
+        self.requests.put('flush')
+        self.requests.join()
+
+    def close(self):
+        """
+        Commits results and closes the connection
+        """
+        self.requests.put(None)
+        self.thread.join()
+        if self.skipped:
+            print(f"GIN inspection: {self.skipped} samples skipped while previous inspection was running")
+        self.cur.close()
+        self.conn.close()
+
+
+class InsertWriter:
+    """
+    Inserts rows one by one, each row in its own transaction
+    """
+    def __init__(self, session, table_name):
+        self.conn = session.conn
+        self.cur = session.cur
+        self.statements = session.statements
+        self.query = f"INSERT INTO {table_name} (jsonb_data) VALUES ($1)"
+        self.conflict_query = self.query + DEDUP_CONFLICT
+        self.manifest = session.manifest
+        self.errors = 0
+        self.duplicates = 0
+
+    def write(self, event_str, suspected=False):
+        """
+        Inserts one row, returns insert and commit runtime or None if insert failed
+        Suspected duplicate is skipped if event with the same id is in the table
+        """
+        try:
+            self.conn.commit()
+            insert_start = datetime.now()
+            self.statements.execute(self.conflict_query if suspected else self.query, (event_str, ))
+            if suspected and self.cur.rowcount == 0:
+                self.duplicates += 1
+            if self.manifest:
+                self.manifest.checkpoint()
+            self.conn.commit()
+            return datetime.now() - insert_start
+        except Exception as error:
+            print(f" {datetime.now()}: Skipping row, Error: {error}")
+            self.conn.rollback()
+            self.errors += 1
+            return None
+
+    def close(self):
+        """
+        Commits pending work
+        """
+        if self.manifest:
+            self.manifest.checkpoint()
+        self.conn.commit()
+
+
+class CopyWriter:
+    """
+    Buffers rows and loads them in batches with COPY FROM STDIN
+
+    With freeze set the table must have been created in the current transaction,
+    batches until the first commit are loaded with COPY FREEZE. Commit interval
+    is not applied then, the creating transaction stays open until close at the
+    end of the hour, so all rows of the hour are frozen. Manifest checkpoint of
+    such hour is stored only by that commit, after a crash the hour is loaded
+    again from its start together with the rolled back table. Frozen batches are
+    spooled into a temporary file. If such batch fails, the transaction is rolled
+    back, table is created again by recreate callback and the spooled batches are
+    loaded without FREEZE.
+    Suspected duplicates are inserted with ON CONFLICT DO NOTHING after COPY of
+    their batch, so they are skipped also when the first copy is in the same batch.
+    All suspected rows of the batch are inserted by one statement, row by row
+    inserts are used only when it fails.
+    """
+    def __init__(self, session, table_name, args, freeze=False, recreate=None):
+        self.conn = session.conn
+        self.cur = session.cur
+        self.statements = session.statements
+        self.table_name = table_name
+        self.manifest = session.manifest
+        self.freeze = freeze
+        self.recreate = recreate
+        self.frozen_rows = None
+        self.query = f"COPY {table_name} (jsonb_data) FROM STDIN"
+        # with dedup rows of failed batch can be duplicates of already loaded events
+        self.insert_query = f"INSERT INTO {table_name} (jsonb_data) VALUES ($1)"
+        if session.dedup:
+            self.insert_query += DEDUP_CONFLICT
+        self.suspected_query = (f"INSERT INTO {table_name} (jsonb_data) SELECT unnest($1::text[])::jsonb"
+                                f"{DEDUP_CONFLICT}")
+        self.batch_rows = args.batch_rows
+        self.batch_bytes = args.batch_bytes
+        self.commit_rows = args.commit_rows
+        self.commit_bytes = args.commit_bytes
+        self.buffer = []
+        self.suspected = []
+        self.buffer_rows = 0
+        self.buffer_bytes = 0
+        self.uncommitted_rows = 0
+        self.uncommitted_bytes = 0
+        self.errors = 0
+        self.duplicates = 0
+        self.rows = 0
+
+    def write(self, event_str, suspected=False):
+        """
+        Adds one row to the batch, returns batch runtime when the batch was sent
+        Suspected duplicate is skipped if event with the same id is in the table
+        """
+        if self.add(event_str, suspected):
+            return self.flush()
+        return None
+
+    def add(self, event_str, suspected=False):
+        """
+        Adds one row to the buffer, returns True when the batch is full
+        """
+        # serialized JSON never contains raw control characters, only backslashes need escaping
+        # for the COPY text format
+        (self.suspected if suspected else self.buffer).append(event_str.replace('\\', '\\\\'))
+        self.buffer_rows += 1
+        self.buffer_bytes += len(event_str)
+        self.rows += 1
+        return self.buffer_rows >= self.batch_rows or self.buffer_bytes >= self.batch_bytes
+
+    def flush(self):
+        """
+        Sends buffered rows with COPY and commits when commit interval is reached
+        """
+        batch_start = datetime.now()
+        if not self.send():
+            return None
+        if self.commit_due(self.uncommitted_rows, self.uncommitted_bytes):
+            self.commit()
+        return datetime.now() - batch_start
+
+    def send(self):
+        """
+        Sends buffered rows with COPY without commit, returns False if the buffer was empty
+        """
+        if not self.buffer and not self.suspected:
+            return False
+        if self.buffer and self.freeze:
+            self.copy_frozen_batch(self.buffer)
+        elif self.buffer:
+            self.copy_batch(self.buffer)
+        if self.suspected:
+            self.insert_suspected(self.suspected)
+
+        self.uncommitted_rows += self.buffer_rows
+        self.uncommitted_bytes += self.buffer_bytes
+        self.buffer = []
+        self.suspected = []
+        self.buffer_rows = 0
+        self.buffer_bytes = 0
+        return True
+
+    def commit_due(self, uncommitted_rows, uncommitted_bytes):
+        """
+        Returns True when sent rows should be committed
+        """
+        if self.freeze:
+            # commit ends the transaction which created the table, next batches could not be frozen
+            return False
+        # without commit interval commit after each batch, otherwise after whichever limit comes first
+        return ((not self.commit_rows and not self.commit_bytes) or
+                (self.commit_rows and uncommitted_rows >= self.commit_rows) or
+                (self.commit_bytes and uncommitted_bytes >= self.commit_bytes))
+
+    def copy_batch(self, batch):
+        """
+        Sends batch with COPY, falls back to row by row inserts if COPY fails
+        """
+        self.cur.execute("SAVEPOINT copy_batch")
+        try:
+            self.cur.copy_expert(self.query, io.StringIO('\n'.join(batch) + '\n'))
+            self.cur.execute("RELEASE SAVEPOINT copy_batch")
+        except Exception as error:
+            # fall back to row by row inserts to skip only broken rows
+            print(f" {datetime.now()}: COPY batch failed, inserting rows one by one, Error: {error}")
+            self.cur.execute("ROLLBACK TO SAVEPOINT copy_batch")
+            self.insert_rows(batch)
+
+    def copy_frozen_batch(self, batch):
+        """
+        Sends batch with COPY FREEZE, batch is spooled until commit to be able to repeat it without FREEZE
+        """
+        if self.frozen_rows is None:
+            self.frozen_rows = tempfile.TemporaryFile('w+', encoding='utf-8')
+        # COPY FREEZE is not allowed inside savepoint, failed batch aborts the whole transaction
+        try:
+            self.cur.copy_expert(f"{self.query} WITH (FREEZE)", io.StringIO('\n'.join(batch) + '\n'))
+            self.frozen_rows.write('\n'.join(batch) + '\n')
+        except Exception as error:
+            print(f" {datetime.now()}: COPY FREEZE batch failed, loading uncommitted rows without FREEZE, Error: {error}")
+            self.conn.rollback()
+            self.freeze = False
+            self.recreate()
+            self.frozen_rows.seek(0)
+            while True:
+                frozen_batch = [line.rstrip('\n') for line in itertools.islice(self.frozen_rows, self.batch_rows)]
+                if not frozen_batch:
+                    break
+                self.copy_batch(frozen_batch)
+            self.copy_batch(batch)
+            self.close_frozen_rows()
+
+    def close_frozen_rows(self):
+        """
+        Removes spooled frozen batches
+        """
+        if self.frozen_rows is not None:
+            self.frozen_rows.close()
+            self.frozen_rows = None
+
+    def insert_suspected(self, batch):
+        """
+        Inserts suspected duplicates of the batch with one statement, falls back to row by row inserts if it fails
+        """
+        self.cur.execute("SAVEPOINT copy_suspected")
+        try:
+            self.statements.execute(self.suspected_query, ([line.replace('\\\\', '\\') for line in batch], ))
+            self.duplicates += len(batch) - self.cur.rowcount
+            self.cur.execute("RELEASE SAVEPOINT copy_suspected")
+        except Exception as error:
+            print(f" {datetime.now()}: Insert of suspected rows failed, inserting rows one by one, Error: {error}")
+            self.cur.execute("ROLLBACK TO SAVEPOINT copy_suspected")
+            self.insert_rows(batch)
+
+    def insert_rows(self, batch):
+        """
+        Inserts rows of the batch one by one, each row protected by its own savepoint
+        """
+        for line in batch:
+            self.cur.execute("SAVEPOINT copy_row")
+            try:
+                self.statements.execute(self.insert_query, (line.replace('\\\\', '\\'), ))
+                if self.cur.rowcount == 0:
+                    self.duplicates += 1
+                self.cur.execute("RELEASE SAVEPOINT copy_row")
+            except Exception as error:
+                print(f" {datetime.now()}: Skipping row, Error: {error}")
+                self.cur.execute("ROLLBACK TO SAVEPOINT copy_row")
+                self.errors += 1
+
+    def commit(self):
+        """
+        Commits rows sent so far
+        """
+        if self.manifest:
+            self.manifest.checkpoint()
+        self.conn.commit()
+        # table creation is committed, next batches can not be frozen anymore
+        self.freeze = False
+        self.close_frozen_rows()
+        self.uncommitted_rows = 0
+        self.uncommitted_bytes = 0
+
+    def close(self):
+        """
+        Sends remaining rows and commits
+        """
+        self.flush()
+        self.commit()
+
+
+class RoutedWriter:
+    """
+    Routes rows by event type to CopyWriter of route table of the type
 
-            cur.execute(f"SET inspect_gin_index.table_name='{table_name}'")
-            cur.execute(f"SET inspect_gin_index.index_name='{gin_index_name}'")
-            cur.execute("SET inspect_gin_index.result_target='table'")
-            cur.execute(f"SET inspect_gin_index.insert_commit_runtime='{insert_commit_runtime}'")
+    Routes share one transaction. Commit interval applies to all routes together,
+    buffers of all routes are sent before commit, so manifest checkpoint never
+    covers rows still waiting in buffer of another route. Rows of the load are
+    committed before route table of a new type is created, DDL in the router
+    connection would otherwise wait forever for locks held by this transaction.
+    """
+    def __init__(self, session, args):
+        self.session = session
+        self.args = args
+        self.routes = {}
+
+    def write(self, event_str, suspected=False):
+        """
+        Adds one row to its route, returns batch runtime when batch of the route was sent
+        """
+        row_type = event_type(event_str)
+        if not self.session.router.known(row_type):
+            # current line is not written yet, checkpoint covers lines before it
+            self.commit(self.session.manifest.line - 1 if self.session.manifest else None)
+        table = self.session.router.table(row_type)
+        route = self.routes.get(table)
+        if route is None:
+            route = self.routes[table] = CopyWriter(self.session, table, self.args)
+            # manifest is checkpointed once for all routes
+            route.manifest = None
+        if not route.add(event_str, suspected):
+            return None
+        batch_start = datetime.now()
+        route.send()
+        if route.commit_due(sum(route.uncommitted_rows for route in self.routes.values()),
+                            sum(route.uncommitted_bytes for route in self.routes.values())):
+            self.commit()
+        return datetime.now() - batch_start
+
+    def commit(self, line=None):
+        """
+        Sends buffers of all routes and commits, manifest checkpoint stores line if it is set
+        """
+        for route in self.routes.values():
+            route.send()
+        if self.session.manifest:
+            self.session.manifest.checkpoint(line)
+        self.session.conn.commit()
+        for route in self.routes.values():
+            route.commit()
+
+    def close(self):
+        """
+        Sends remaining rows and commits
+        """
+        self.commit()
+        print(f"  {datetime.now()}: rows per route: "
+              f"{', '.join(f'{table} {route.rows}' for table, route in sorted(self.routes.items()))}")
+
+    @property
+    def errors(self):
+        return sum(route.errors for route in self.routes.values())
+
+    @property
+    def duplicates(self):
+        return sum(route.duplicates for route in self.routes.values())
+
+
+class TypeRouter:
+    """
+    Route tables of event types, table of a type is created when the type appears first time
+
+    With mode partition route table is LIST partition of the loaded table, which is
+    partitioned by jsonb_data->>'type'. With mode table it is table inheriting the
+    loaded table with CHECK constraint on type (queries on the loaded table skip
+    other types by constraint exclusion) and with copies of its indexes.
+    Tables are created in own connection with autocommit, so DDL does not commit
+    rows of the load and parallel workers see tables created by each other.
+    Writer must commit its rows before a table is created, see known.
+    """
+    def __init__(self, connection, table_name, mode, catalog, debug=False):
+        self.table_name = table_name
+        self.mode = mode
+        self.catalog = catalog
+        self.debug = debug
+        self.conn = open_connection(connection)
+        self.conn.autocommit = True
+        self.cur = self.conn.cursor()
+        self.routes = {}
+
+    def route_name(self, event_type):
+        """
+        Returns name of route table of the type
+        """
+        suffix = re.sub(r'[^a-z0-9]+', '_', event_type.lower()).strip('_') if event_type else ''
+        return f"{self.table_name}_{suffix or 'untyped'}"
+
+    def known(self, event_type):
+        """
+        Returns True if route table of the type was already returned, so table does not create it
+        """
+        return event_type in self.routes
+
+    def table(self, event_type):
+        """
+        Returns route table of the type, creates it if needed
+        """
+        table = self.routes.get(event_type)
+        if table is None:
+            table = self.routes[event_type] = self.create(event_type)
+        return table
+
+    def exists(self, table):
+        """
+        Returns True if the table exists
+        """
+        self.cur.execute("SELECT to_regclass(%s) IS NOT NULL", (table, ))
+        return self.cur.fetchone()[0]
+
+    def create(self, event_type):
+        """
+        Creates route table of the type if it does not exist, returns its name
+        """
+        table = self.route_name(event_type)
+        if self.exists(table):
+            return table
+        value = self.cur.mogrify('%s', (event_type, )).decode('utf-8')
+        if self.mode == 'partition':
+            query = f"CREATE TABLE {table} PARTITION OF {self.table_name} FOR VALUES IN ({value})"
+        else:
+            check = f"jsonb_data->>'type' = {value}" if event_type is not None else "jsonb_data->>'type' IS NULL"
+            query = (f"CREATE TABLE {table} (LIKE {self.table_name} INCLUDING ALL, CHECK ({check})) "
+                     f"INHERITS ({self.table_name})")
+        print(f"  {datetime.now()}: creating route table {table} for type {event_type}")
+        print(f"  {datetime.now()}: {query}") if self.debug else None
+        try:
+            self.cur.execute(query)
+        except psycopg2.Error:
+            # parallel worker could have created the table first
+            if not self.exists(table):
+                raise
+        self.catalog.refresh()
+        return table
+
+    def tables(self):
+        """
+        Returns loaded table and all its route tables
+        """
+        self.cur.execute("SELECT inhrelid::regclass::text FROM pg_inherits WHERE inhparent = %s::regclass ORDER BY 1",
+                         (self.table_name, ))
+        return [self.table_name] + [row[0] for row in self.cur.fetchall()]
+
+    def close(self):
+        """
+        Closes connection of the router
+        """
+        self.cur.close()
+        self.conn.close()
+
+
+class PartitionStager:
+    """
+    Loads daily partitions of RANGE partitioned table as standalone tables
+
+    Partition of the day is created as a plain table in the transaction of its
+    first COPY, so rows can be loaded with COPY FREEZE. Indexes and constraints
+    of the parent table are built when the day is loaded and only then the table
+    is attached as partition, so the parent table and its indexes are not
+    maintained during the load. Catalog cache is refreshed when a partition
+    is created or attached.
+    """
+    def __init__(self, conn, cur, table_name, catalog, debug=False):
+        self.conn = conn
+        self.cur = cur
+        self.table_name = table_name
+        self.catalog = catalog
+        self.debug = debug
+        # partition which is being loaded and its day
+        self.staged = None
+
+        cur.execute("SELECT pg_get_partkeydef(%s::regclass)", (table_name, ))
+        partition_key = cur.fetchone()[0]
+        print(f"  {datetime.now()}: partition key: {partition_key}") if debug else None
+        if not partition_key or not partition_key.startswith('RANGE'):
+            print(f"ERROR: Daily partitions can be created only for RANGE partitioned table, {table_name} has: {partition_key}")
+            sys.exit(1)
+
+    def partition_name(self, day):
+        """
+        Returns name of partition for the day, same as the suffix used for partition sizes
+        """
+        return f"{self.table_name}_{day.strftime('%Y%m%d')}"
+
+    def prepare(self, day):
+        """
+        Returns partition to load for the day and flag if it was created in current transaction
+        Previously staged partition of other day is attached first
+        """
+        partition = self.partition_name(day)
+        if self.staged and self.staged[0] == partition:
+            # next hour of the day which is being loaded
+            print(f"  {datetime.now()}: loading staged partition {partition}")
+            return partition, False
+        if self.staged:
+            self.attach()
+
+        if partition.split('.')[-1] in self.catalog.partitions(self.cur, self.table_name):
+            # partition already attached by previous run, rows go directly into it
+            print(f"  {datetime.now()}: loading attached partition {partition}")
+            return partition, False
+
+        self.staged = (partition, day)
+        if self.catalog.relkind(self.cur, partition):
+            print(f"  {datetime.now()}: loading staged partition {partition}")
+            return partition, False
+
+        self.create(partition)
+        return partition, True
+
+    def create(self, partition):
+        """
+        Creates standalone table for partition, without indexes and without commit
+        """
+        print(f"  {datetime.now()}: creating staged partition {partition}")
+        self.cur.execute(f"CREATE TABLE {partition} (LIKE {self.table_name} INCLUDING DEFAULTS INCLUDING CONSTRAINTS "
+                         "INCLUDING GENERATED INCLUDING STORAGE INCLUDING COMPRESSION)")
+        self.catalog.refresh()
+
+    def attach(self):
+        """
+        Builds indexes on staged partition and attaches it to the parent table
+        """
+        if not self.staged:
+            return
+        partition, day = self.staged
+        attach_start = datetime.now()
+        self.cur.execute("SELECT pg_get_indexdef(i.indexrelid), pg_get_constraintdef(con.oid) "
+                         "FROM pg_index i LEFT JOIN pg_constraint con ON con.conindid = i.indexrelid "
+                         "AND con.conrelid = i.indrelid WHERE i.indrelid = %s::regclass",
+                         (self.table_name, ))
+        for indexdef, constraintdef in self.cur.fetchall():
+            if constraintdef:
+                # index of primary key or unique constraint must be attached as constraint
+                query = f"ALTER TABLE {partition} ADD {constraintdef}"
+            else:
+                # let PostgreSQL choose index name, ATTACH PARTITION matches indexes by definition
+                query = re.sub(r'^CREATE (UNIQUE )?INDEX \S+ ON ONLY \S+ ', rf'CREATE \1INDEX ON {partition} ', indexdef)
+            print(f"  {datetime.now()}: {query}")
+            self.cur.execute(query)
+
+        next_day = day + timedelta(days=1)
+        query = (f"ALTER TABLE {self.table_name} ATTACH PARTITION {partition} "
+                 f"FOR VALUES FROM ('{day.strftime('%Y-%m-%d')}') TO ('{next_day.strftime('%Y-%m-%d')}')")
+        print(f"  {datetime.now()}: {query}")
+        self.cur.execute(query)
+        self.conn.commit()
+        self.catalog.refresh()
+        self.staged = None
+        print(f"  {datetime.now()}: partition {partition} attached in {datetime.now() - attach_start}")
+
+    def attach_leftovers(self):
+        """
+        Attaches staged partitions left by interrupted runs
+        """
+        self.cur.execute("SELECT c.oid::regclass::text, right(c.relname, 8) FROM pg_class c "
+                         "JOIN pg_class p ON p.oid = %s::regclass AND c.relnamespace = p.relnamespace "
+                         "WHERE c.relkind = 'r' AND c.relname ~ ('^' || p.relname || '_[0-9]{8}$') "
+                         "AND NOT EXISTS (SELECT 1 FROM pg_inherits i WHERE i.inhrelid = c.oid)",
+                         (self.table_name, ))
+        for partition, day in self.cur.fetchall():
+            print(f"  {datetime.now()}: attaching staged partition {partition} left by previous run")
+            self.staged = (self.partition_name(datetime.strptime(day, '%Y%m%d')), datetime.strptime(day, '%Y%m%d'))
+            self.attach()
+
+
+class LoadManifest:
+    """
+    Records load progress of each hour in manifest table
 
-            print(f"  {datetime.now()}: inspect_gin_index_script: {args.gin_inspection_script}") if args.debug else None
-            with open(args.gin_inspection_script, 'r') as file:
-                query = file.read()
-                cur.execute(query)
-                conn.commit()
+    Number of source lines consumed is updated in the same transaction which
+    commits the loaded rows, so after a crash the hour can continue exactly
+    after the last committed line.
+    """
+    def __init__(self, conn, cur, manifest_table, table_name):
+        self.conn = conn
+        self.cur = cur
+        self.manifest_table = manifest_table
+        self.table_name = table_name
+        self.file_name = None
+        self.line = 0
+        self.cur.execute(f"CREATE TABLE IF NOT EXISTS {manifest_table} ("
+                         "table_name TEXT NOT NULL, "
+                         "file_name TEXT NOT NULL, "
+                         "status TEXT NOT NULL, "
+                         "lines_committed BIGINT NOT NULL DEFAULT 0, "
+                         "rows_inserted BIGINT, "
+                         "errors BIGINT, "
+                         "started_at TIMESTAMPTZ NOT NULL DEFAULT now(), "
+                         "finished_at TIMESTAMPTZ, "
+                         "PRIMARY KEY (table_name, file_name))")
+        self.conn.commit()
+
+    def completed_files(self):
+        """
+        Returns set of files completely loaded into the table
+        """
+        self.cur.execute(f"SELECT file_name FROM {self.manifest_table} WHERE table_name = %s AND status = 'done'",
+                         (self.table_name, ))
+        return {row[0] for row in self.cur.fetchall()}
+
+    def start(self, file_name):
+        """
+        Registers start of the file load, returns number of lines already committed by previous runs
+        """
+        self.file_name = file_name
+        self.cur.execute(f"INSERT INTO {self.manifest_table} (table_name, file_name, status) "
+                         "VALUES (%s, %s, 'loading') ON CONFLICT (table_name, file_name) DO NOTHING",
+                         (self.table_name, file_name))
+        self.cur.execute(f"SELECT lines_committed FROM {self.manifest_table} WHERE table_name = %s AND file_name = %s",
+                         (self.table_name, file_name))
+        self.line = self.cur.fetchone()[0]
+        self.conn.commit()
+        return self.line
+
+    def checkpoint(self, line=None):
+        """
+        Stores current line (or line if it is set) as committed, must be called inside the transaction
+        which commits the rows
+        """
+        self.cur.execute(f"UPDATE {self.manifest_table} SET lines_committed = %s WHERE table_name = %s AND file_name = %s",
+                         (self.line if line is None else line, self.table_name, self.file_name))
+
+    def finish(self, rows, errors):
+        """
+        Marks the file as completely loaded, rows and errors are counts of the run which finished the file
+        """
+        self.cur.execute(f"UPDATE {self.manifest_table} SET status = 'done', finished_at = now(), "
+                         "rows_inserted = %s, errors = %s "
+                         "WHERE table_name = %s AND file_name = %s",
+                         (rows, errors, self.table_name, self.file_name))
+        self.conn.commit()
+
+    def reset(self):
+        """
+        Removes records of the table, used when the table was dropped or truncated
+        """
+        self.cur.execute(f"DELETE FROM {self.manifest_table} WHERE table_name = %s", (self.table_name, ))
+
+
+class LoadSession:
+    """
+    Connection of loading process with helpers bound to it for the whole run
+    """
+    def __init__(self, conn, cur, debug=False):
+        self.conn = conn
+        self.cur = cur
+        self.catalog = CatalogCache(debug)
+        self.statements = PreparedStatements(cur)
+        self.cache = None
+        self.manifest = None
+        self.stager = None
+        self.inspector = None
+        self.transform_pool = None
+        self.dedup = None
+        self.router = None
 
 
 # Function to download, process, and delete files
-def download_process_file(conn, cur, start_date, args):
+def download_process_file(session, start_date, args, prefetched=None):
     """
     Downloads, processes, and deletes files
+    If prefetched future is set, file is not downloaded but taken from the future
+    If session cache is set, file is taken from the local cache and kept there
+    If session manifest is set, lines committed by previous runs are skipped and progress is recorded
+    If session stager is set, rows are loaded into daily partition staged as standalone table
+    If session inspector is set, GIN indexes are inspected after inserts (sampled) and after the file is loaded
+    If session dedup filter is set, events suspected to be loaded already are skipped by unique index on event id
+    If session router is set, rows are loaded into route tables of their event types
     """
+    conn, cur = session.conn, session.cur
+    manifest, stager, inspector = session.manifest, session.stager, session.inspector
     date_str = start_date.strftime("%Y-%m-%d-%H")
     url = f"https://data.gharchive.org/{date_str}.json.gz"
     print(f"* {datetime.now()}: Processing {url}")
@@ -182,15 +1274,7 @@ def download_process_file(conn, cur, start_date, args):
     print(f"unix_timestamp: {unix_timestamp}") if args.debug else None
 
     # check type of the table
-    if '.' in args.table_name:
-        schema_name, table_name = args.table_name.split('.')
-        query_type = (f"SELECT relkind FROM pg_class WHERE relnamespace::regnamespace::text = '{schema_name}' AND relname = '{table_name}';")
-    else:
-        query_type = (f"SELECT relkind FROM pg_class WHERE relname = '{args.table_name}';")
-
-    print(f"  {datetime.now()}: query_type: {query_type}")
-    cur.execute(query_type)
-    relkind = cur.fetchone()[0]
+    relkind = session.catalog.relkind(cur, args.table_name)
     print(f"  {datetime.now()}: table type: {relkind}")
 
     partition_date = ""
@@ -201,67 +1285,93 @@ def download_process_file(conn, cur, start_date, args):
 
     row = 0
     errors = 0
+    duplicates = 0
     table_size = 0
     relation_size = 0
     indexes_size = 0
     loop_start = datetime.now()
 
+    # number of lines of the file already loaded by previous runs
+    resume_line = 0
+    if manifest:
+        resume_line = manifest.start(date_str)
+        if resume_line:
+            print(f"  {datetime.now()}: resuming after line {resume_line}")
+
+    # events are parsed and encoded again only for filters and transformations, other lines go through fast path
+    transform = build_transform(args)
+
     try:
         loop_start = datetime.now()
-        local_filename = "/tmp/" + url.split('/')[-1]
-        # Download the file - randomize the file name to avoid conflicts
-        local_filename = local_filename + '.' + str(loop_start.strftime("%Y-%m-%d-%H-%M-%S-%f"))
-        print(f"  {loop_start}: downloading {local_filename} ")
-
-        with requests.get(url, stream=True, timeout=300) as req:
-            req.raise_for_status()
-            with open(local_filename, 'wb') as file:
-                for chunk in req.iter_content(chunk_size=8192):
-                    file.write(chunk)
-
-        print(f"  {datetime.now()}: downloaded")
-        file_stats = os.stat(local_filename)
-        print(f"  {datetime.now()}: file size: {file_stats.st_size}")
-
-        # Uncompress and process the file
-        with gzip.open(local_filename, 'rb') as file:
+        stream_stats = {}
+        # Download (or take from cache) and uncompress the file
+        with open_archive_chunks(url, args.stream, prefetched, session.cache, stream_stats) as chunks:
             # start time of the loop
             loop_start = datetime.now()
-            print(f"  {loop_start}: processing {local_filename}, table {args.table_name}")
-            for line in file:
-                event = json.loads(line)
-                if args.random_drop:
-                    event = drop_random_keys(event)
-
-                event_str = json.dumps(event).replace(r'\u0000', '').replace('`', "'")
-                row += 1
-
-                # print number of rows processed every 25000 rows
-                if row % 25000 == 0:
-                    print(f"  {datetime.now()}: processed {row} rows")
-
-                # Process and insert the data into PostgreSQL here
-                try:
-                    conn.commit()
-                    insert_start = datetime.now()
-                    query = f"INSERT INTO {args.table_name} (jsonb_data) VALUES (%s)"
-                    cur.execute(query, (event_str, ))
-                    conn.commit()
-                    insert_commit_runtime = datetime.now() - insert_start
-
-                    if args.gin_inspection_after_insert:
-                        print(f"GIN inspection: file {date_str} after {row} rows inserted")
-                        inspect_gin_index(conn, cur, f'{args.table_name}{partition_date}', args, insert_commit_runtime)
-
-                except Exception as error:
-                    print(f" {datetime.now()}: Skipping row: {row}, Error: {error}")
-                    errors += 1
-
-        print(f"  Inserted into {args.table_name}: {row} rows, errors: {errors}")
+            print(f"  {loop_start}: processing {stream_stats['source']}, table {args.table_name}")
+            if inspector:
+                inspector.new_file()
+            target_table = args.table_name
+            freeze = False
+            if stager:
+                target_table, freeze = stager.prepare(start_date)
+
+            if session.router:
+                writer = RoutedWriter(session, args)
+            elif args.copy or stager:
+                writer = CopyWriter(session, target_table, args, freeze, lambda: stager.create(target_table))
+            else:
+                writer = InsertWriter(session, target_table)
+
+            # lines loaded by previous runs are skipped before they are parsed
+            line_number = resume_line
+            pipeline = None
+            if args.pipeline:
+                pipeline = LoadPipeline(chunks, transform, session.transform_pool, args.pipeline_memory * 1024 * 1024,
+                                        args.transform_chunk_lines, skip_lines=resume_line,
+                                        decompressor=args.decompressor, stats=stream_stats, unit=date_str)
+                events = pipeline.rows()
+            else:
+                lines = itertools.islice(iter_gzip_lines(chunks, args.decompressor, stream_stats), resume_line, None)
+                events = serialize_lines(lines, transform, session.transform_pool, date_str, resume_line)
+            if args.sort_key:
+                # rows are clustered by sort key, filtered empty rows are dropped
+                events = sort_rows(events, args.sort_key, args.sort_window)
+            try:
+                for event_str in events:
+                    line_number += 1
+                    if manifest:
+                        manifest.line = line_number
+                    if not event_str:
+                        continue
+                    row += 1
+
+                    # print number of rows processed every 25000 rows
+                    if row % 25000 == 0:
+                        print(f"  {datetime.now()}: processed {row} rows")
+
+                    # Process and insert the data into PostgreSQL here
+                    suspected = session.dedup.suspected(event_str) if session.dedup else False
+                    insert_commit_runtime = writer.write(event_str, suspected)
+
+                    if inspector and args.gin_inspection_after_insert and insert_commit_runtime is not None:
+                        inspector.sample(f'{args.table_name}{partition_date}', row, insert_commit_runtime)
+            finally:
+                if pipeline:
+                    pipeline.close()
+
+            writer.close()
+            errors = writer.errors
+            duplicates = writer.duplicates
+
+        print(f"  Inserted into {args.table_name}: {row - duplicates} rows, errors: {errors}, "
+              f"duplicates skipped: {duplicates}")
         conn.commit()
-
-        # Delete the file
-        os.remove(local_filename)
+        if manifest:
+            manifest.finish(row - errors - duplicates, errors)
+        if session.dedup:
+            # filter is saved only after commit, ids of uncommitted rows are only checked by the database next time
+            session.dedup.hour_loaded()
         loop_end = datetime.now()
         print(f"  {loop_end}: processed in {loop_end - loop_start}")
     except requests.exceptions.HTTPError:
@@ -275,29 +1385,296 @@ def download_process_file(conn, cur, start_date, args):
     runtime = loop_end - loop_start
     total_run_time_seconds = round(runtime.total_seconds(),3)
     rows_per_second = round(row / total_run_time_seconds,3)
+    decompress_seconds = stream_stats.get('decompress_seconds', 0)
+    decompress_mb_per_second = (round(stream_stats['decompressed_bytes'] / 1024 / 1024 / decompress_seconds, 3)
+                                if decompress_seconds else 0)
 
     # inspect GIN index
-    inspect_gin_index(conn, cur, f'{args.table_name}{partition_date}', args, runtime)
-
-    query_sizes = (f"SELECT pg_relation_size('{args.table_name}{partition_date}'), "
-                  f"pg_table_size('{args.table_name}{partition_date}'), "
-                  f"pg_indexes_size('{args.table_name}{partition_date}');")
+    if inspector:
+        inspector.request(f'{args.table_name}{partition_date}', runtime)
 
-    print(f"  {datetime.now()}: query_sizes: {query_sizes}")
-    cur.execute(query_sizes)
-
-    sizes = cur.fetchone()
-    relation_size = sizes[0]
-    table_size = sizes[1]
-    indexes_size = sizes[2]
+    size_tables = session.router.tables() if session.router else [f'{args.table_name}{partition_date}']
+    relation_size, table_size, indexes_size = relation_sizes(session, size_tables)
     print(f"  {datetime.now()}: table size: {table_size}")
 
     # open new csv file for writing runtimes of each loop
-    with open(args.runtime_file, 'a') as csv_file:
-        csv_file.write(f'{date_str},{unix_timestamp},{loop_start},'
+    append_runtime_row(args.runtime_file,
+                       f'{date_str},{unix_timestamp},{loop_start},'
                        f'{loop_end},{runtime},{total_run_time_seconds},'
                        f'{relation_size},{table_size},{indexes_size},'
-                       f'{row},{rows_per_second},{errors}\n')
+                       f'{row},{rows_per_second},{errors},'
+                       f'{load_mode(args)},'
+                       f'{stream_stats.get("decompressor", "")},{decompress_mb_per_second},{duplicates}\n')
+    return row
+
+
+def relation_sizes(session, tables):
+    """
+    Returns relation, table and indexes size of the tables together
+    """
+    sizes = [0, 0, 0]
+    for table in tables:
+        session.statements.execute(SIZES_QUERY, (table, ))
+        sizes = [total + size for total, size in zip(sizes, session.cur.fetchone())]
+    return sizes
+
+
+def load_mode(args):
+    """
+    Returns load mode for runtime file
+    """
+    mode = "copy" if args.copy or args.create_partitions or args.route_by_type else "insert"
+    if args.route_by_type:
+        mode = f"{mode}_routed_{args.route_by_type}"
+    return f"{mode}_sorted" if args.sort_key else mode
+
+
+def append_runtime_row(runtime_file, line):
+    """
+    Appends row to runtime file, rows of parallel workers are serialized by lock
+    """
+    if RUNTIME_FILE_LOCK is None:
+        with open(runtime_file, 'a') as csv_file:
+            csv_file.write(line)
+        return
+    with RUNTIME_FILE_LOCK:
+        with open(runtime_file, 'a') as csv_file:
+            csv_file.write(line)
+
+
+def init_worker(args, lock):
+    """
+    Initializes worker process, connection is opened by the first load_hours
+    Failure in pool initializer would make the pool start new workers forever, failure of load_hours
+    is returned to the parent process
+    """
+    global RUNTIME_FILE_LOCK
+    RUNTIME_FILE_LOCK = lock
+    WORKER.update(session=None, args=args)
+
+
+def open_worker_session(args):
+    """
+    Opens connection of worker process and returns its session
+    """
+    connection = read_yaml(args.connection)
+    conn = open_connection(connection)
+    session = LoadSession(conn, conn.cursor(), args.debug)
+    if args.cache_dir:
+        session.cache = ArchiveCache(args.cache_dir, args.cache_max_size * 1024 * 1024, debug=args.debug, cleanup=False)
+    if args.manifest_table:
+        session.manifest = LoadManifest(conn, session.cur, args.manifest_table, args.table_name)
+    if args.create_partitions:
+        session.stager = PartitionStager(conn, session.cur, args.table_name, session.catalog, args.debug)
+    if args.gin_inspection_script:
+        session.inspector = GinInspector(connection, args, session.catalog)
+    if args.route_by_type:
+        session.router = TypeRouter(connection, args.table_name, args.route_by_type, session.catalog, args.debug)
+    return session
+
+
+def load_hours(hours):
+    """
+    Loads list of hours in worker process, returns first hour, number of hours and number of rows
+    """
+    rows = 0
+    try:
+        if WORKER['session'] is None:
+            WORKER['session'] = open_worker_session(WORKER['args'])
+        session = WORKER['session']
+        for hour in hours:
+            rows += download_process_file(session, hour, WORKER['args'])
+        if session.stager:
+            session.stager.attach()
+        if session.inspector:
+            # worker processes are terminated by the pool, results must be committed now
+            session.inspector.flush()
+    except SystemExit as error:
+        # sys.exit would kill the worker process and leave the pool waiting for its result
+        raise RuntimeError(f"load of {hours[0]} failed") from error
+    return hours[0], len(hours), rows
+
+
+def load_in_workers(hours, args):
+    """
+    Spreads hours (or days with --create_partitions) over worker processes, largest first
+    Returns number of loaded rows
+    """
+    units = []
+    for hour in hours:
+        if args.create_partitions and units and units[-1][0].date() == hour.date():
+            units[-1].append(hour)
+        else:
+            units.append([hour])
+
+    # longest processing time first - big hours are started early and do not make long tail at the end
+    urls = [f"https://data.gharchive.org/{hour.strftime('%Y-%m-%d-%H')}.json.gz" for hour in hours]
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        sizes = dict(zip(hours, executor.map(remote_size, urls)))
+    units.sort(key=lambda unit: sum(sizes[hour] for hour in unit), reverse=True)
+    print(f"Loading {len(units)} units in {args.workers} workers")
+
+    context = multiprocessing.get_context('spawn')
+    lock = context.Lock()
+    rows = 0
+    with context.Pool(args.workers, initializer=init_worker, initargs=(args, lock)) as pool:
+        for first_hour, count, unit_rows in pool.imap_unordered(load_hours, units, chunksize=1):
+            print(f"* {datetime.now()}: worker finished {count} hours from {first_hour}")
+            rows += unit_rows
+    return rows
+
+
+def load_sequentially(session, hours, args):
+    """
+    Loads hours one by one in the main process, returns number of loaded rows
+    """
+    if args.cache_dir:
+        print(f"Cache directory: {args.cache_dir}")
+        session.cache = ArchiveCache(args.cache_dir, args.cache_max_size * 1024 * 1024, debug=args.debug)
+
+    prefetcher = None
+    if args.prefetch > 0:
+        urls = [f"https://data.gharchive.org/{hour.strftime('%Y-%m-%d-%H')}.json.gz" for hour in hours]
+        prefetcher = HourPrefetcher(urls, args.prefetch, args.prefetch_disk_budget * 1024 * 1024, debug=args.debug, cache=session.cache)
+
+    rows = 0
+    for index, hour in enumerate(hours):
+        # Download, process, and delete the file
+        rows += download_process_file(session, hour, args, prefetcher.get(index) if prefetcher else None)
+
+    if prefetcher:
+        prefetcher.close()
+
+    if session.stager:
+        # attach partition of the last loaded day
+        session.stager.attach()
+    return rows
+
+
+# start of index definition up to the indexed table, replaced to compare or copy indexes of different tables
+INDEX_TARGET = re.compile(r'^CREATE (UNIQUE )?INDEX (\S+) ON (ONLY )?\S+ ')
+
+
+def child_index_def(indexdef, child):
+    """
+    Returns definition of copy of parent index on inheritance child, index is named after child and parent index
+    """
+    match = INDEX_TARGET.match(indexdef)
+    name = f"{child.split('.')[-1]}_{match.group(2).split('.')[-1]}"
+    return f"CREATE {match.group(1) or ''}INDEX {name} ON {child} " + indexdef[match.end():]
+
+
+def inheritance_children(cur, args):
+    """
+    Returns route tables inheriting the table, empty list when routes are not inheritance tables
+    """
+    if args.route_by_type != 'table':
+        return []
+    cur.execute("SELECT inhrelid::regclass::text FROM pg_inherits WHERE inhparent = %s::regclass ORDER BY 1",
+                (args.table_name, ))
+    return [row[0] for row in cur.fetchall()]
+
+
+def drop_deferred_indexes(conn, cur, args):
+    """
+    Drops indexes of the table and returns their definitions
+    Definitions are saved into file next to the runtime file, so that indexes dropped by
+    interrupted run are built by the next run
+    Partitions lose indexes of partitioned table with them. Inheritance route tables copy indexes
+    only when they are created, so their copies of the indexes are dropped and built again too.
+    """
+    index_file = f"{args.runtime_file}.deferred_indexes.sql"
+    index_defs = []
+    if os.path.exists(index_file):
+        with open(index_file, 'r') as file:
+            index_defs = [line.strip().rstrip(';') for line in file if line.strip()]
+        print(f"Deferred indexes of previous run: {len(index_defs)}")
+
+    # indexes of primary key, unique constraints and unique indexes (dedup) are kept
+    cur.execute("SELECT i.indexrelid::regclass::text, pg_get_indexdef(i.indexrelid) FROM pg_index i "
+                "WHERE i.indrelid = %s::regclass AND NOT i.indisunique "
+                "AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conindid = i.indexrelid)",
+                (args.table_name, ))
+    indexes = cur.fetchall()
+    # index of partitioned table is defined ON ONLY parent, it must be built for all partitions
+    index_defs += [indexdef.replace(' ON ONLY ', ' ON ', 1) for _, indexdef in indexes
+                   if indexdef.replace(' ON ONLY ', ' ON ', 1) not in index_defs]
+    with open(index_file, 'w') as file:
+        file.write(''.join(f"{indexdef};\n" for indexdef in index_defs))
+
+    children = inheritance_children(cur, args)
+    if children:
+        parent_indexes = {INDEX_TARGET.sub('', indexdef) for indexdef in index_defs}
+        cur.execute("SELECT i.indexrelid::regclass::text, pg_get_indexdef(i.indexrelid) FROM pg_index i "
+                    "WHERE i.indrelid = ANY(%s::regclass[]) AND NOT i.indisunique "
+                    "AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conindid = i.indexrelid)",
+                    (children, ))
+        # other indexes of route tables are kept
+        indexes += [(index_name, indexdef) for index_name, indexdef in cur.fetchall()
+                    if INDEX_TARGET.sub('', indexdef) in parent_indexes]
+
+    for index_name, indexdef in indexes:
+        print(f"Dropping index {index_name}: {indexdef}")
+        cur.execute(f"DROP INDEX {index_name}")
+    conn.commit()
+    return index_defs
+
+
+def build_deferred_indexes(conn, cur, args, index_defs):
+    """
+    Builds dropped indexes with parallel maintenance workers, returns runtime
+    Indexes of partitioned table are built on all its partitions, copies of indexes are built
+    on all inheritance route tables
+    """
+    build_start = datetime.now()
+    cur.execute("SELECT set_config('max_parallel_maintenance_workers', %s, false), "
+                "set_config('maintenance_work_mem', %s, false)",
+                (str(args.index_build_workers), args.maintenance_work_mem))
+    children = inheritance_children(cur, args)
+    for parent_indexdef in index_defs:
+        for indexdef in [parent_indexdef] + [child_index_def(parent_indexdef, child) for child in children]:
+            # index could have been built already by interrupted previous run
+            indexdef = re.sub(r'^CREATE (UNIQUE )?INDEX ', r'CREATE \1INDEX IF NOT EXISTS ', indexdef)
+            index_start = datetime.now()
+            print(f"  {index_start}: building index: {indexdef}")
+            cur.execute(indexdef)
+            conn.commit()
+            print(f"  {datetime.now()}: index built in {datetime.now() - index_start}")
+    os.remove(f"{args.runtime_file}.deferred_indexes.sql")
+    return build_start, datetime.now()
+
+
+def run_probe_query(session, args):
+    """
+    Runs probe query probe_runs times, returns start and end of the fastest run
+    """
+    fastest = None
+    for run in range(args.probe_runs):
+        start = datetime.now()
+        session.cur.execute(args.probe_query)
+        session.cur.fetchall()
+        end = datetime.now()
+        print(f"  {end}: probe query run {run + 1}: {end - start}")
+        if fastest is None or end - start < fastest[1] - fastest[0]:
+            fastest = (start, end)
+    session.conn.commit()
+    return fastest
+
+
+def append_summary_row(session, args, name, start, end, rows):
+    """
+    Appends summary row of whole run phase (load, index build, probe query) into runtime file
+    """
+    runtime = end - start
+    total_run_time_seconds = round(runtime.total_seconds(), 3)
+    rows_per_second = round(rows / total_run_time_seconds, 3) if total_run_time_seconds else 0
+    size_tables = session.router.tables() if session.router else [args.table_name]
+    relation_size, table_size, indexes_size = relation_sizes(session, size_tables)
+    append_runtime_row(args.runtime_file,
+                       f'{name},,{start},{end},{runtime},{total_run_time_seconds},'
+                       f'{relation_size},{table_size},{indexes_size},'
+                       f'{rows},{rows_per_second},0,'
+                       f'{load_mode(args)},,,\n')
 
 
 def main():
@@ -309,11 +1686,52 @@ def main():
 
     # Parse command line arguments
     args = parse_input()
+    print(f"JSON library: {JSON_LIBRARY}") if args.debug else None
 
     if args.gin_inspection_after_insert and args.gin_inspection_script is None:
         print("ERROR: You requested GIN index inspection after each insert but GIN inspection script is not set!")
         sys.exit(1)
 
+    # fail early when requested decompression backend is not installed
+    try:
+        decompressor, _ = decompressor_backend(args.decompressor)
+    except ValueError as error:
+        print(f"ERROR: {error}")
+        sys.exit(1)
+    print(f"Decompressor: {decompressor}")
+
+    if args.random_drop and not 0 <= args.random_drop_min <= args.random_drop_max:
+        print("ERROR: Random drop needs 0 <= random_drop_min <= random_drop_max!")
+        sys.exit(1)
+
+    if args.stream and args.prefetch > 0:
+        print("ERROR: Streaming load and prefetch of files can not be combined!")
+        sys.exit(1)
+
+    if args.workers > 1 and args.prefetch > 0:
+        print("ERROR: Parallel workers and prefetch of files can not be combined!")
+        sys.exit(1)
+
+    if args.workers > 1 and args.transform_workers > 0:
+        print("ERROR: Parallel workers and transform workers can not be combined!")
+        sys.exit(1)
+
+    if args.sort_key and args.manifest_table:
+        print("ERROR: Manifest table requires rows loaded in order of lines, sort_key can not be used!")
+        sys.exit(1)
+
+    if args.transform_unordered and args.manifest_table:
+        print("ERROR: Manifest table requires rows loaded in order, transform_unordered can not be used!")
+        sys.exit(1)
+
+    if args.route_by_type and args.create_partitions:
+        print("ERROR: Routing by type and daily partitions can not be combined!")
+        sys.exit(1)
+
+    if args.dedup and args.workers > 1:
+        print("ERROR: Dedup filter is kept by one process, parallel workers can not be used!")
+        sys.exit(1)
+
     start_date = datetime.strptime(args.start, "%Y-%m-%d-%H")
     end_date = datetime.strptime(args.end, "%Y-%m-%d-%H")
 
@@ -334,7 +1752,9 @@ def main():
     # Drop table if requested
     if args.drop_table:
         print(f"Dropping table: {args.table_name}")
-        cur.execute(f"DROP TABLE IF EXISTS {args.table_name};")
+        cur.execute(f"DROP VIEW IF EXISTS {args.table_name}_expanded;")
+        # route tables inheriting the table are dropped with it
+        cur.execute(f"DROP TABLE IF EXISTS {args.table_name}{' CASCADE' if args.route_by_type else ''};")
         conn.commit()
 
     # Check if table exists
@@ -348,15 +1768,70 @@ def main():
     if not table_exists:
         # Create table
         create_table_query = f"CREATE TABLE {args.table_name} (id SERIAL PRIMARY KEY, jsonb_data JSONB compression lz4, data_source VARCHAR)"
+        if args.route_by_type == 'partition':
+            # primary key of partitioned table would have to contain the partition key
+            create_table_query = (f"CREATE TABLE {args.table_name} (id SERIAL, jsonb_data JSONB compression lz4, "
+                                  f"data_source VARCHAR) PARTITION BY LIST ((jsonb_data->>'type'))")
         cur.execute(create_table_query)
         conn.commit()
         print(f"Table {args.table_name} created.")
 
+    if args.compact_urls:
+        # view restoring URL fields removed by compaction
+        schema_name = args.table_name.split('.')[0] if '.' in args.table_name else 'public'
+        cur.execute(expand_function_sql(schema_name))
+        cur.execute(f"CREATE OR REPLACE VIEW {args.table_name}_expanded AS "
+                    f"SELECT id, {schema_name}.gharchive_expand(jsonb_data) AS jsonb_data, data_source "
+                    f"FROM {args.table_name}")
+        conn.commit()
+        print(f"View {args.table_name}_expanded restores compacted URL fields")
+
     # Truncate table if requested
     if args.truncate_table:
         print(f"Truncating table: {args.table_name}")
         cur.execute(f"TRUNCATE TABLE {args.table_name};")
 
+    session = LoadSession(conn, cur, args.debug)
+
+    if args.dedup:
+        # unique index of partitioned table must contain partition key, event id alone can not be unique there
+        if session.catalog.relkind(cur, args.table_name) == 'p':
+            print("ERROR: Dedup needs unique index on event id, it can not be used for partitioned table!")
+            sys.exit(1)
+        index_name = f"{args.table_name.split('.')[-1]}_event_id_key"
+        print(f"Dedup: unique index {index_name}")
+        try:
+            cur.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {index_name} ON {args.table_name} ((jsonb_data->>'id'))")
+            conn.commit()
+        except psycopg2.Error as error:
+            print(f"ERROR: Unique index on event id can not be created, table contains duplicates? Error: {error}")
+            sys.exit(1)
+        dedup_filter = args.dedup_filter or f"{args.table_name}.event_ids.bloom"
+        if (args.drop_table or args.truncate_table) and os.path.exists(dedup_filter):
+            os.remove(dedup_filter)
+        session.dedup = EventIdFilter(dedup_filter, args.dedup_capacity, args.dedup_error_rate, args.dedup_save_hours)
+
+    if args.route_by_type == 'partition':
+        cur.execute("SELECT partstrat FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)", (args.table_name, ))
+        strategy = cur.fetchone()
+        if not strategy or strategy[0] != 'l':
+            print("ERROR: Routing into partitions needs table LIST partitioned by jsonb_data->>'type'!")
+            sys.exit(1)
+    elif args.route_by_type and session.catalog.relkind(cur, args.table_name) != 'r':
+        print("ERROR: Routing into tables needs ordinary table, use partition routing for partitioned table!")
+        sys.exit(1)
+    if args.route_by_type:
+        print(f"Routing events by type into {args.route_by_type}s of {args.table_name}")
+        session.router = TypeRouter(connection, args.table_name, args.route_by_type, session.catalog, args.debug)
+
+    manifest = None
+    if args.manifest_table:
+        print(f"Manifest table: {args.manifest_table}")
+        manifest = session.manifest = LoadManifest(conn, cur, args.manifest_table, args.table_name)
+        if args.drop_table or args.truncate_table:
+            manifest.reset()
+            conn.commit()
+
     print(f"Date range {start_date} - {end_date}")
     print(f"Table: {args.table_name}")
     # Loop over the timeframe
@@ -364,20 +1839,74 @@ def main():
     # open new csv file for writing runtimes of each loop
     print(f'Runtimes file: {args.runtime_file}') if args.debug else None
 
-    # if rewrite_runtime_file is set, delete the file if exists
-    if args.rewrite_runtime_file:
-        os.remove(args.runtime_file) if os.path.exists(args.runtime_file) else None
-
-    if not os.path.exists(args.runtime_file):
-        with open(args.runtime_file, 'w') as csv_file:
-            csv_file.write(
-                'file_name,unix_timestamp,loop_start,loop_end,runtime,total_run_time_seconds,relation_size,table_size,index_size,rows_inserted,rows_per_second,errors\n')
+    # runtime file is created with header (again if rewrite_runtime_file is set), rows of other version are not mixed
+    if not prepare_runtime_file(args.runtime_file, RUNTIME_FILE_HEADER, args.rewrite_runtime_file):
+        print(f"ERROR: Runtime file {args.runtime_file} has different columns, "
+              "use --rewrite_runtime_file or other runtime file!")
+        sys.exit(1)
 
+    hours = []
     while start_date <= end_date:
-        # Download, process, and delete the file
-        download_process_file(conn, cur, start_date, args)
+        hours.append(start_date)
         start_date += delta
 
+    if manifest:
+        completed_files = manifest.completed_files()
+        skipped = [hour for hour in hours if hour.strftime("%Y-%m-%d-%H") in completed_files]
+        if skipped:
+            print(f"Skipping {len(skipped)} hours already loaded according to manifest")
+        hours = [hour for hour in hours if hour.strftime("%Y-%m-%d-%H") not in completed_files]
+
+    if args.create_partitions:
+        session.stager = PartitionStager(conn, cur, args.table_name, session.catalog, args.debug)
+        session.stager.attach_leftovers()
+
+    index_defs = []
+    if args.defer_indexes:
+        index_defs = drop_deferred_indexes(conn, cur, args)
+
+    load_start = datetime.now()
+    if args.workers > 1:
+        if args.cache_dir:
+            # cleanup of partial files before workers start to share the cache
+            ArchiveCache(args.cache_dir, args.cache_max_size * 1024 * 1024, debug=args.debug)
+        conn.commit()
+        rows = load_in_workers(hours, args)
+    else:
+        if args.gin_inspection_script:
+            session.inspector = GinInspector(connection, args, session.catalog)
+        if args.transform_workers > 0:
+            transform = build_transform(args)
+            session.transform_pool = TransformPool(args.transform_workers, transform, args.transform_chunk_lines,
+                                                   not args.transform_unordered)
+        rows = load_sequentially(session, hours, args)
+        if session.dedup:
+            session.dedup.save()
+        if session.transform_pool:
+            session.transform_pool.close()
+        if session.inspector:
+            session.inspector.close()
+    load_end = datetime.now()
+
+    if args.defer_indexes or args.sort_key or args.probe_query:
+        # table size after whole load, to compare sorted and unsorted loads
+        append_summary_row(session, args, 'load_total', load_start, load_end, rows)
+
+    if args.defer_indexes:
+        print(f"Building {len(index_defs)} deferred indexes")
+        build_start, build_end = build_deferred_indexes(conn, cur, args, index_defs)
+        print(f"Deferred indexes built in {build_end - build_start}")
+        append_summary_row(session, args, 'index_build', build_start, build_end, rows)
+
+    if args.probe_query:
+        print(f"Running probe query: {args.probe_query}")
+        probe_start, probe_end = run_probe_query(session, args)
+        print(f"Fastest probe query run: {probe_end - probe_start}")
+        append_summary_row(session, args, 'probe_query', probe_start, probe_end, 0)
+
+    if session.router:
+        session.router.close()
+
     # Commit and close PostgreSQL connection
     conn.commit()
     cur.close()
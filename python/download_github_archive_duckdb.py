@@ -2,15 +2,42 @@
 Script to download Github archive data and load them into PostgreSQL
 """
 import argparse
-import gzip
+import io
 import os
-import json
-import random
 from datetime import datetime, timedelta
 import sys
 import requests
 import duckdb
 import yaml
+from gharchive_stream import (decompressor_backend, iter_gzip_lines, open_archive_chunks, open_archive_file,
+                              read_archive_bytes)
+from gharchive_prefetch import HourPrefetcher
+from gharchive_cache import ArchiveCache
+from gharchive_common import prepare_runtime_file, sql_literal
+from gharchive_events import JSON_LIBRARY, build_transform
+from gharchive_transform import TransformPool, serialize_lines, sort_rows
+from gharchive_pipeline import LoadPipeline
+from gharchive_lake import LakeWriter
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+try:
+    # needs fsspec
+    from duckdb.filesystem import ModifiedMemoryFileSystem
+except ImportError:
+    ModifiedMemoryFileSystem = None
+
+DATABASE_FILE = 'json_data.duckdb'
+
+# protocol of in-memory filesystem with downloaded hourly files
+MEMORY_PROTOCOL = 'gharchive'
+
+RUNTIME_FILE_HEADER = ('file_name,unix_timestamp,loop_start,loop_end,runtime,total_run_time_seconds,'
+                       'relation_size,table_size,index_size,rows_inserted,rows_per_second,errors,load_mode,'
+                       'decompressor,decompress_mb_per_second\n')
 
 def read_yaml(filename):
     """
@@ -117,7 +144,182 @@ def parse_input():
         '-rd',
         '--random_drop',
         action='store_true',
-        help='If set script drops randomly from 1 to 3 keys in each row')
+        help='If set script drops random keys in each row, see random_drop_* options')
+
+    parser.add_argument(
+        '--random_drop_seed',
+        type=int,
+        help='Random drop: seed making dropped keys reproducible between runs')
+
+    parser.add_argument(
+        '--random_drop_keys',
+        nargs='+',
+        help='Random drop: keys which can be dropped, all keys if not set')
+
+    parser.add_argument(
+        '--random_drop_min',
+        type=int,
+        default=1,
+        help='Random drop: minimal number of keys dropped from each event')
+
+    parser.add_argument(
+        '--random_drop_max',
+        type=int,
+        default=3,
+        help='Random drop: maximal number of keys dropped from each event')
+
+    parser.add_argument(
+        '--random_drop_depth',
+        type=int,
+        default=1,
+        help='Random drop: keys of nested objects up to this depth can be dropped, 1 means top level keys only')
+
+    parser.add_argument(
+        '-st',
+        '--stream',
+        action='store_true',
+        help='If set script decompresses and loads data while downloading instead of storing file in /tmp')
+
+    parser.add_argument(
+        '-pf',
+        '--prefetch',
+        type=int,
+        default=0,
+        help='Number of next hours downloaded concurrently while the current hour is loaded, 0 disables prefetch')
+
+    parser.add_argument(
+        '--prefetch_disk_budget',
+        type=int,
+        default=2048,
+        help='Prefetch: maximal size in MB of downloaded files waiting for load')
+
+    parser.add_argument(
+        '-cd',
+        '--cache_dir',
+        required=False,
+        help='Directory for persistent cache of downloaded files, files are kept there and reused by next runs')
+
+    parser.add_argument(
+        '--cache_max_size',
+        type=int,
+        default=20480,
+        help='Cache: maximal size of cache directory in MB, least recently used files are evicted, 0 means unlimited')
+
+    parser.add_argument(
+        '-tw',
+        '--transform_workers',
+        type=int,
+        default=0,
+        help='Number of processes parsing and transforming lines, 0 means lines are processed by the loader process')
+
+    parser.add_argument(
+        '--transform_chunk_lines',
+        type=int,
+        default=10000,
+        help='Transform workers: number of lines sent to worker process in one chunk')
+
+    parser.add_argument(
+        '--transform_unordered',
+        action='store_true',
+        help='Transform workers: rows are loaded in order of finished chunks instead of order of lines in the file')
+
+    parser.add_argument(
+        '-pl',
+        '--pipeline',
+        action='store_true',
+        help='If set reading, decompression and transformation of lines run as separate stages in threads '
+             'connected by bounded queues, in parallel with database writes')
+
+    parser.add_argument(
+        '--pipeline_memory',
+        type=int,
+        default=512,
+        help='Pipeline: memory budget in MB for data waiting in queues between stages')
+
+    parser.add_argument(
+        '-dc',
+        '--decompressor',
+        default='auto',
+        choices=['auto', 'zlib', 'isal', 'zlib_ng'],
+        help='Decompression backend, auto selects the fastest installed one (isal, zlib_ng, zlib)')
+
+    parser.add_argument(
+        '--include_types',
+        nargs='+',
+        help='Load only events of these types, e.g. PushEvent PullRequestEvent')
+
+    parser.add_argument(
+        '--include_repos',
+        nargs='+',
+        help='Load only events of these repositories, e.g. postgres/postgres')
+
+    parser.add_argument(
+        '--project',
+        nargs='+',
+        help='Store only these paths of each event, nested keys separated by dot, e.g. type repo.name payload.size')
+
+    parser.add_argument(
+        '--sort_key',
+        nargs='+',
+        help='Sort rows by these paths (nested keys separated by dot) before they are written, '
+             'e.g. type repo.id created_at')
+
+    parser.add_argument(
+        '--sort_window',
+        type=int,
+        default=0,
+        help='Sort: number of rows sorted together, 0 means whole hour')
+
+    parser.add_argument(
+        '--probe_query',
+        required=False,
+        help='Query run after the load to measure query speed on loaded table, fastest run goes into runtime file')
+
+    parser.add_argument(
+        '--probe_runs',
+        type=int,
+        default=3,
+        help='Probe query: number of runs')
+
+    parser.add_argument(
+        '-nj',
+        '--native_json',
+        action='store_true',
+        help='If set each hourly file is loaded by one INSERT ... SELECT from DuckDB read_json_objects, '
+             'events are not parsed in Python, only include_types and include_repos filters can be used')
+
+    parser.add_argument(
+        '-ab',
+        '--arrow_batch_rows',
+        type=int,
+        default=0,
+        help='Number of rows collected into Arrow record batch inserted by one statement (needs pyarrow), '
+             '0 means rows are inserted one by one')
+
+    parser.add_argument(
+        '-ld',
+        '--lake_dir',
+        required=False,
+        help='If set events are written into Parquet lake in this directory instead of the table, '
+             'partitioned by date, hour and type (needs pyarrow), see gharchive_lake.py for compaction and queries')
+
+    parser.add_argument(
+        '--lake_row_group_rows',
+        type=int,
+        default=128 * 1024,
+        help='Lake: number of rows in Parquet row group')
+
+    parser.add_argument(
+        '--lake_compression',
+        default='zstd',
+        help='Lake: Parquet compression, e.g. zstd, snappy, gzip, none')
+
+    parser.add_argument(
+        '-im',
+        '--in_memory',
+        action='store_true',
+        help='Native JSON: hourly file is downloaded into memory and read by DuckDB from in-memory filesystem '
+             '(needs fsspec), nothing is written to /tmp')
 
     args = parser.parse_args()
 
@@ -126,19 +328,6 @@ def parse_input():
     print(f"end: {args.end}")
     return args
 
-def drop_random_keys(event):
-    """
-    Drops random keys from event
-    """
-    keys = list(event.keys())
-    random.shuffle(keys)
-    num_keys_to_drop = random.randint(1, 3)
-    keys_to_drop = random.sample(keys, num_keys_to_drop)
-    for key in keys_to_drop:
-        del event[key]
-    return event
-
-
 def inspect_gin_index(conn, cur, table_name, args, insert_commit_runtime):
     """
     Inspects GIN index
@@ -171,10 +360,174 @@ def inspect_gin_index(conn, cur, table_name, args, insert_commit_runtime):
                 conn.commit()
 
 
+def run_probe_query(cur, args):
+    """
+    Runs probe query probe_runs times, returns start and end of the fastest run
+    """
+    fastest = None
+    for run in range(args.probe_runs):
+        start = datetime.now()
+        cur.execute(args.probe_query)
+        cur.fetchall()
+        end = datetime.now()
+        print(f"  {end}: probe query run {run + 1}: {end - start}")
+        if fastest is None or end - start < fastest[1] - fastest[0]:
+            fastest = (start, end)
+    return fastest
+
+
+def insert_native_json(cur, filename, args):
+    """
+    Loads gzipped newline delimited JSON file with DuckDB JSON reader, returns number of inserted rows
+    Lines which are not valid JSON are skipped by the reader
+    """
+    # JSON arrow operators bind weaker than IN and AND in DuckDB, each extracted value is in parentheses
+    conditions = []
+    if args.include_types:
+        conditions.append(f"(json->>'type') IN ({', '.join(sql_literal(name) for name in args.include_types)})")
+    if args.include_repos:
+        conditions.append(f"(json->'repo'->>'name') IN "
+                          f"({', '.join(sql_literal(name) for name in args.include_repos)})")
+    query = (f"INSERT INTO {args.table_name} (json_data) SELECT json "
+             f"FROM read_json_objects({sql_literal(filename)}, format='newline_delimited', compression='gzip', "
+             f"ignore_errors=true)")
+    if conditions:
+        query += f" WHERE {' AND '.join(conditions)}"
+    print(f"  {datetime.now()}: query: {query}") if args.debug else None
+    cur.execute(query)
+    return cur.fetchone()[0]
+
+
+if ModifiedMemoryFileSystem is not None:
+    class ArchiveMemoryFileSystem(ModifiedMemoryFileSystem):
+        """
+        In-memory fsspec filesystem registered in DuckDB, files are read as gharchive://<name>
+        """
+        protocol = (MEMORY_PROTOCOL, )
+
+
+def insert_memory_json(cur, memory_fs, data, date_str, args):
+    """
+    Loads hourly file downloaded into memory (compressed bytes) with DuckDB JSON reader,
+    returns number of inserted rows
+    """
+    path = f"{MEMORY_PROTOCOL}://{date_str}.json.gz"
+    memory_fs.add_file(io.BytesIO(data), path)
+    try:
+        return insert_native_json(cur, path, args)
+    finally:
+        memory_fs.rm(path)
+
+
+class ArrowBatchWriter:
+    """
+    Collects rows into Arrow record batches, each batch is inserted by one INSERT ... SELECT
+    from the batch registered as relation, DuckDB scans Arrow data without copying them
+
+    Ids are assigned by counter of the writer, not by nextval default of each
+    inserted row. Counter starts after the highest id of the table and after one
+    value taken from json_id sequence, DuckDB can not move the sequence by more
+    than one value per call. Rows loaded later by other modes with the nextval
+    default can therefore repeat ids of rows loaded by this writer. Batch which
+    fails (invalid JSON) is inserted row by row and failed rows are skipped.
+    """
+    def __init__(self, cur, table_name, batch_rows):
+        self.cur = cur
+        self.table_name = table_name
+        self.batch_rows = batch_rows
+        self.rows = []
+        self.errors = 0
+        self.next_id = None
+
+    def write(self, event_str):
+        """
+        Adds one row to the batch, returns batch runtime when the batch was inserted
+        """
+        self.rows.append(event_str)
+        if len(self.rows) >= self.batch_rows:
+            return self.flush()
+        return None
+
+    def reserve_ids(self, count):
+        """
+        Returns first id of block of count ids, counter is initialized by the first call
+        """
+        if self.next_id is None:
+            self.cur.execute(f"SELECT greatest((SELECT coalesce(max(id), 0) + 1 FROM {self.table_name}), "
+                             "nextval('json_id'))")
+            self.next_id = self.cur.fetchone()[0]
+        first_id = self.next_id
+        self.next_id += count
+        return first_id
+
+    def flush(self):
+        """
+        Inserts collected rows
+        """
+        if not self.rows:
+            return None
+        batch_start = datetime.now()
+        first_id = self.reserve_ids(len(self.rows))
+        ids = range(first_id, first_id + len(self.rows))
+        batch = pyarrow.Table.from_arrays([pyarrow.array(ids, pyarrow.int64()),
+                                           pyarrow.array(self.rows, pyarrow.string())], names=['id', 'json_data'])
+        self.cur.register('arrow_batch', batch)
+        try:
+            self.cur.execute(f"INSERT INTO {self.table_name} (id, json_data) SELECT id, json_data FROM arrow_batch")
+        except duckdb.Error as error:
+            print(f" {datetime.now()}: Arrow batch failed, inserting rows one by one, Error: {error}")
+            self.insert_rows(ids)
+        finally:
+            self.cur.unregister('arrow_batch')
+        self.rows = []
+        return datetime.now() - batch_start
+
+    def insert_rows(self, ids):
+        """
+        Inserts rows of the batch one by one with their reserved ids
+        """
+        for row_id, event_str in zip(ids, self.rows):
+            try:
+                self.cur.execute(f"INSERT INTO {self.table_name} (id, json_data) VALUES (?, ?)", [row_id, event_str])
+            except duckdb.Error as error:
+                print(f" {datetime.now()}: Skipping row, Error: {error}")
+                self.errors += 1
+
+    def close(self):
+        """
+        Inserts remaining rows
+        """
+        self.flush()
+
+
+def database_size(cur):
+    """
+    Returns size of used blocks of the database
+    """
+    cur.execute("SELECT used_blocks * block_size FROM pragma_database_size()")
+    return cur.fetchone()[0]
+
+
+def load_mode(args):
+    """
+    Returns load mode for runtime file
+    """
+    mode = "native_json" if args.native_json else "arrow" if args.arrow_batch_rows else "insert"
+    if args.lake_dir:
+        mode = "lake"
+    return f"{mode}_sorted" if args.sort_key else mode
+
+
 # Function to download, process, and delete files
-def download_process_file(conn, cur, start_date, args):
+def download_process_file(conn, cur, start_date, args, prefetched=None, cache=None, transform_pool=None,
+                          memory_fs=None):
     """
     Downloads, processes, and deletes files
+    If prefetched future is set, file is not downloaded but taken from the future
+    If cache is set, file is taken from the local cache and kept there
+    If transform_pool is set, lines are parsed and transformed in its worker processes
+    With native_json the file is parsed and inserted by DuckDB JSON reader in one statement
+    If memory_fs is set, the file is downloaded into it instead of /tmp
     """
     date_str = start_date.strftime("%Y-%m-%d-%H")
     url = f"https://data.gharchive.org/{date_str}.json.gz"
@@ -204,69 +557,94 @@ def download_process_file(conn, cur, start_date, args):
 
     row = 0
     errors = 0
+    lake_bytes = 0
     table_size = 0
     relation_size = 0
     indexes_size = 0
     loop_start = datetime.now()
 
+    # events are parsed and encoded again only for filters and transformations, other lines go through fast path
+    transform = build_transform(args)
+
     try:
-        loop_start = datetime.now()
-        local_filename = "/tmp/" + url.split('/')[-1]
-        # Download the file - randomize the file name to avoid conflicts
-        local_filename = local_filename + '.' + str(loop_start.strftime("%Y-%m-%d-%H-%M-%S-%f"))
-        print(f"  {loop_start}: downloading {local_filename} ")
-
-        with requests.get(url, stream=True, timeout=300) as req:
-            req.raise_for_status()
-            with open(local_filename, 'wb') as file:
-                for chunk in req.iter_content(chunk_size=8192):
-                    file.write(chunk)
-
-        print(f"  {datetime.now()}: downloaded")
-        file_stats = os.stat(local_filename)
-        print(f"  {datetime.now()}: file size: {file_stats.st_size}")
-
-        # Uncompress and process the file
-        with gzip.open(local_filename, 'rb') as file:
-            # start time of the loop
+        stream_stats = {}
+        if memory_fs:
+            data = read_archive_bytes(url, cache, stream_stats)
+            # load starts when the file is in memory, download time is not included like in other modes
             loop_start = datetime.now()
-            print(f"  {loop_start}: processing {local_filename}, table {args.table_name}")
-            for line in file:
-                event = json.loads(line)
-                if args.random_drop:
-                    event = drop_random_keys(event)
-
-                event_str = json.dumps(event).replace(r'\u0000', '').replace('`', "'")
-                row += 1
-
-                # print number of rows processed every 25000 rows
-                if row % 25000 == 0:
-                    print(f"  {datetime.now()}: processed {row} rows")
-
-                # Process and insert the data into PostgreSQL here
+            print(f"  {loop_start}: loading {stream_stats['source']} from memory, table {args.table_name}")
+            row = insert_memory_json(cur, memory_fs, data, date_str, args)
+        elif args.native_json:
+            with open_archive_file(url, prefetched, cache, stream_stats) as filename:
+                loop_start = datetime.now()
+                print(f"  {loop_start}: loading {filename} with read_json_objects, table {args.table_name}")
+                row = insert_native_json(cur, filename, args)
+        else:
+            # Download (or take from cache) and uncompress the file
+            with open_archive_chunks(url, args.stream, prefetched, cache, stream_stats) as chunks:
+                # start time of the loop
+                loop_start = datetime.now()
+                print(f"  {loop_start}: processing {stream_stats['source']}, table {args.table_name}")
+                pipeline = None
+                if args.pipeline:
+                    pipeline = LoadPipeline(chunks, transform, transform_pool, args.pipeline_memory * 1024 * 1024,
+                                            args.transform_chunk_lines, decompressor=args.decompressor,
+                                            stats=stream_stats, unit=date_str)
+                    events = pipeline.rows()
+                else:
+                    lines = iter_gzip_lines(chunks, args.decompressor, stream_stats)
+                    events = serialize_lines(lines, transform, transform_pool, date_str)
+                if args.sort_key:
+                    # rows are clustered by sort key, filtered empty rows are dropped
+                    events = sort_rows(events, args.sort_key, args.sort_window)
+                writer = None
+                if args.lake_dir:
+                    writer = LakeWriter(args.lake_dir, date_str, args.lake_row_group_rows, args.lake_compression)
+                elif args.arrow_batch_rows:
+                    writer = ArrowBatchWriter(cur, args.table_name, args.arrow_batch_rows)
                 try:
-                    conn.commit()
-                    insert_start = datetime.now()
-                    json_data=event_str.replace("'","''")
-                    query = f"INSERT INTO {args.table_name} (json_data) VALUES ('{json_data}')"
-                    cur.execute(query)
-                    conn.commit()
-                    insert_commit_runtime = datetime.now() - insert_start
-
-                    # if args.gin_inspection_after_insert:
-                    #     print(f"GIN inspection: file {date_str} after {row} rows inserted")
-                    #     inspect_gin_index(conn, cur, f'{args.table_name}{partition_date}', args, insert_commit_runtime)
-
-                except Exception as error:
-                    print(f" {datetime.now()}: Skipping row: {row}, Error: {error}")
-                    # print(f"command: {query}")
-                    errors += 1
+                    for event_str in events:
+                        if not event_str:
+                            continue
+                        row += 1
+
+                        # print number of rows processed every 25000 rows
+                        if row % 25000 == 0:
+                            print(f"  {datetime.now()}: processed {row} rows")
+
+                        if writer:
+                            writer.write(event_str)
+                            continue
+
+                        # Process and insert the data into PostgreSQL here
+                        try:
+                            conn.commit()
+                            insert_start = datetime.now()
+                            json_data=event_str.replace("'","''")
+                            query = f"INSERT INTO {args.table_name} (json_data) VALUES ('{json_data}')"
+                            cur.execute(query)
+                            conn.commit()
+                            insert_commit_runtime = datetime.now() - insert_start
+
+                            # if args.gin_inspection_after_insert:
+                            #     print(f"GIN inspection: file {date_str} after {row} rows inserted")
+                            #     inspect_gin_index(conn, cur, f'{args.table_name}{partition_date}', args, insert_commit_runtime)
+
+                        except Exception as error:
+                            print(f" {datetime.now()}: Skipping row: {row}, Error: {error}")
+                            # print(f"command: {query}")
+                            errors += 1
+                finally:
+                    if pipeline:
+                        pipeline.close()
+                if writer:
+                    writer.close()
+                    errors = writer.errors
+                    if args.lake_dir:
+                        lake_bytes = writer.bytes
 
         print(f"  Inserted into {args.table_name}: {row} rows, errors: {errors}")
         conn.commit()
-
-        # Delete the file
-        os.remove(local_filename)
         loop_end = datetime.now()
         print(f"  {loop_end}: processed in {loop_end - loop_start}")
     except requests.exceptions.HTTPError:
@@ -280,29 +658,25 @@ def download_process_file(conn, cur, start_date, args):
     runtime = loop_end - loop_start
     total_run_time_seconds = round(runtime.total_seconds(),3)
     rows_per_second = round(row / total_run_time_seconds,3)
+    # decompression throughput, not known when DuckDB reads the compressed file itself
+    decompress_seconds = stream_stats.get('decompress_seconds', 0)
+    decompress_mb_per_second = (round(stream_stats['decompressed_bytes'] / 1024 / 1024 / decompress_seconds, 3)
+                                if decompress_seconds else 0)
 
     # inspect GIN index
     # inspect_gin_index(conn, cur, f'{args.table_name}{partition_date}', args, runtime)
 
-    # query_sizes = (f"SELECT pg_relation_size('{args.table_name}{partition_date}'), "
-    #               f"pg_table_size('{args.table_name}{partition_date}'), "
-    #               f"pg_indexes_size('{args.table_name}{partition_date}');")
-
-    # print(f"  {datetime.now()}: query_sizes: {query_sizes}")
-    # cur.execute(query_sizes)
-
-    # sizes = cur.fetchone()
-    # relation_size = sizes[0]
-    # table_size = sizes[1]
-    # indexes_size = sizes[2]
-    # print(f"  {datetime.now()}: table size: {table_size}")
+    # DuckDB has no relation sizes, table size is size of the whole database or of the lake files of the hour
+    table_size = lake_bytes if args.lake_dir else database_size(cur)
+    print(f"  {datetime.now()}: {'lake files' if args.lake_dir else 'database'} size: {table_size}")
 
-    # # open new csv file for writing runtimes of each loop
-    # with open(args.runtime_file, 'a') as csv_file:
-    #     csv_file.write(f'{date_str},{unix_timestamp},{loop_start},'
-    #                    f'{loop_end},{runtime},{total_run_time_seconds},'
-    #                    f'{relation_size},{table_size},{indexes_size},'
-    #                    f'{row},{rows_per_second},{errors}\n')
+    with open(args.runtime_file, 'a') as csv_file:
+        csv_file.write(f'{date_str},{unix_timestamp},{loop_start},'
+                       f'{loop_end},{runtime},{total_run_time_seconds},'
+                       f',{table_size},,'
+                       f'{row},{rows_per_second},{errors},{load_mode(args)},'
+                       f'{stream_stats.get("decompressor", "")},{decompress_mb_per_second}\n')
+    return row
 
 
 def main():
@@ -314,11 +688,59 @@ def main():
 
     # Parse command line arguments
     args = parse_input()
+    print(f"JSON library: {JSON_LIBRARY}") if args.debug else None
 
     # if args.gin_inspection_after_insert and args.gin_inspection_script is None:
     #     print("ERROR: You requested GIN index inspection after each insert but GIN inspection script is not set!")
     #     sys.exit(1)
 
+    # fail early when requested decompression backend is not installed
+    try:
+        decompressor, _ = decompressor_backend(args.decompressor)
+    except ValueError as error:
+        print(f"ERROR: {error}")
+        sys.exit(1)
+    print(f"Decompressor: {decompressor}")
+
+    if args.random_drop and not 0 <= args.random_drop_min <= args.random_drop_max:
+        print("ERROR: Random drop needs 0 <= random_drop_min <= random_drop_max!")
+        sys.exit(1)
+
+    if args.stream and args.prefetch > 0:
+        print("ERROR: Streaming load and prefetch of files can not be combined!")
+        sys.exit(1)
+
+    if args.arrow_batch_rows and pyarrow is None:
+        print("ERROR: Arrow batches need pyarrow, install it or do not use arrow_batch_rows!")
+        sys.exit(1)
+
+    if args.lake_dir and (pyarrow is None or args.native_json or args.arrow_batch_rows):
+        print("ERROR: Parquet lake needs pyarrow, it can not be combined with native JSON load or Arrow batches!")
+        sys.exit(1)
+
+    if args.arrow_batch_rows and args.native_json:
+        print("ERROR: Native JSON load and Arrow batches can not be combined!")
+        sys.exit(1)
+
+    if args.in_memory and not args.native_json:
+        print("ERROR: In-memory files are read by native JSON load, use native_json!")
+        sys.exit(1)
+
+    if args.in_memory and args.prefetch > 0:
+        print("ERROR: Prefetch stores files in /tmp, it can not be combined with in-memory files!")
+        sys.exit(1)
+
+    if args.in_memory and ModifiedMemoryFileSystem is None:
+        print("ERROR: In-memory files need fsspec, install it or do not use in_memory!")
+        sys.exit(1)
+
+    # DuckDB reader gets whole local file and loads events as they are
+    if args.native_json and (args.stream or args.pipeline or args.transform_workers > 0 or args.random_drop
+                             or args.project or args.sort_key):
+        print("ERROR: Native JSON load can not be combined with stream, pipeline, transform workers, "
+              "random drop, project or sort_key!")
+        sys.exit(1)
+
     start_date = datetime.strptime(args.start, "%Y-%m-%d-%H")
     end_date = datetime.strptime(args.end, "%Y-%m-%d-%H")
 
@@ -333,7 +755,7 @@ def main():
     # conn = open_connection(connection)
 
     print('starting duckdb')
-    conn = duckdb.connect('json_data.duckdb')
+    conn = duckdb.connect(DATABASE_FILE)
 
     # Create cursor
     print("Creating cursor") if args.debug else None
@@ -341,6 +763,11 @@ def main():
 
     cur.execute('INSTALL json')
     cur.execute('LOAD json')
+
+    memory_fs = None
+    if args.in_memory:
+        memory_fs = ArchiveMemoryFileSystem()
+        conn.register_filesystem(memory_fs)
     # Drop table if requested
     if args.drop_table:
         print(f"Dropping table: {args.table_name}")
@@ -380,20 +807,56 @@ def main():
     # open new csv file for writing runtimes of each loop
     print(f'Runtimes file: {args.runtime_file}') if args.debug else None
 
-    # if rewrite_runtime_file is set, delete the file if exists
-    if args.rewrite_runtime_file:
-        os.remove(args.runtime_file) if os.path.exists(args.runtime_file) else None
-
-    if not os.path.exists(args.runtime_file):
-        with open(args.runtime_file, 'w') as csv_file:
-            csv_file.write(
-                'file_name,unix_timestamp,loop_start,loop_end,runtime,total_run_time_seconds,relation_size,table_size,index_size,rows_inserted,rows_per_second,errors\n')
+    # runtime file is created with header (again if rewrite_runtime_file is set), rows of other version are not mixed
+    if not prepare_runtime_file(args.runtime_file, RUNTIME_FILE_HEADER, args.rewrite_runtime_file):
+        print(f"ERROR: Runtime file {args.runtime_file} has different columns, "
+              "use --rewrite_runtime_file or other runtime file!")
+        sys.exit(1)
 
+    hours = []
     while start_date <= end_date:
-        # Download, process, and delete the file
-        download_process_file(conn, cur, start_date, args)
+        hours.append(start_date)
         start_date += delta
 
+    cache = None
+    if args.cache_dir:
+        print(f"Cache directory: {args.cache_dir}")
+        cache = ArchiveCache(args.cache_dir, args.cache_max_size * 1024 * 1024, debug=args.debug)
+
+    prefetcher = None
+    if args.prefetch > 0:
+        urls = [f"https://data.gharchive.org/{hour.strftime('%Y-%m-%d-%H')}.json.gz" for hour in hours]
+        prefetcher = HourPrefetcher(urls, args.prefetch, args.prefetch_disk_budget * 1024 * 1024, debug=args.debug, cache=cache)
+
+    transform_pool = None
+    if args.transform_workers > 0:
+        transform = build_transform(args)
+        transform_pool = TransformPool(args.transform_workers, transform, args.transform_chunk_lines,
+                                       not args.transform_unordered)
+
+    for index, hour in enumerate(hours):
+        # Download, process, and delete the file
+        download_process_file(conn, cur, hour, args, prefetcher.get(index) if prefetcher else None, cache,
+                              transform_pool, memory_fs)
+
+    if prefetcher:
+        prefetcher.close()
+    if transform_pool:
+        transform_pool.close()
+
+    if args.probe_query:
+        # size of database file after the load, to compare sorted and unsorted loads
+        cur.execute('CHECKPOINT')
+        database_file_size = os.path.getsize(DATABASE_FILE)
+        print(f"Database size: {database_file_size}")
+        print(f"Running probe query: {args.probe_query}")
+        probe_start, probe_end = run_probe_query(cur, args)
+        runtime = probe_end - probe_start
+        print(f"Fastest probe query run: {runtime}")
+        with open(args.runtime_file, 'a') as csv_file:
+            csv_file.write(f'probe_query,,{probe_start},{probe_end},{runtime},{round(runtime.total_seconds(), 3)},'
+                           f',{database_file_size},,,,,{load_mode(args)},,\n')
+
     # Commit and close PostgreSQL connection
     conn.commit()
     cur.close()
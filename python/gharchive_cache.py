@@ -0,0 +1,183 @@
+"""
+Persistent local cache of Github archive hourly files shared by the loaders
+
+Files are stored under the original file name (one file per hour) together
+with a .sha256 file holding checksum and size used for integrity check when
+the file is reused. Least recently used files are evicted when the cache
+grows over its size limit, files pinned by the prefetcher until they are
+loaded are never evicted.
+"""
+import hashlib
+import os
+import threading
+from datetime import datetime
+from gharchive_common import timestamped_filename
+from gharchive_prefetch import download_file
+
+CHECKSUM_SUFFIX = '.sha256'
+PARTIAL_SUFFIX = '.part'
+
+
+def file_checksum(filename, chunk_size=1024 * 1024):
+    """
+    Returns sha256 hex digest of the file
+    """
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ArchiveCache:
+    """
+    Size bounded cache of downloaded files keyed by hour
+    """
+
+    def __init__(self, directory, max_size, debug=False, cleanup=True):
+        self.directory = directory
+        self.max_size = max_size
+        self.debug = debug
+        self.lock = threading.Lock()
+        self.pinned = set()
+        os.makedirs(directory, exist_ok=True)
+        if cleanup:
+            # remove leftovers of interrupted downloads, not done by parallel workers sharing the cache
+            for name in os.listdir(directory):
+                if name.endswith(PARTIAL_SUFFIX):
+                    os.remove(os.path.join(directory, name))
+
+    def path(self, url):
+        """
+        Returns cache file name for url
+        """
+        return os.path.join(self.directory, url.split('/')[-1])
+
+    def partial_filename(self, url):
+        """
+        Returns unique temporary file name in the cache directory for download of url
+        """
+        return timestamped_filename(self.path(url), PARTIAL_SUFFIX)
+
+    def pin(self, filename):
+        """
+        Protects cache file from eviction, used for files queued for load
+        """
+        with self.lock:
+            self.pinned.add(filename)
+
+    def unpin(self, filename):
+        """
+        Allows eviction of cache file again
+        """
+        with self.lock:
+            self.pinned.discard(filename)
+
+    def partial_bytes(self, url):
+        """
+        Returns size of unfinished downloads of url in the cache directory
+        """
+        prefix = os.path.basename(self.path(url)) + '.'
+        size = 0
+        for name in os.listdir(self.directory):
+            if name.startswith(prefix) and name.endswith(PARTIAL_SUFFIX):
+                try:
+                    size += os.path.getsize(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    # download finished meanwhile
+                    pass
+        return size
+
+    def get(self, url):
+        """
+        Returns cached file name for url or None if file is not cached or is damaged
+        """
+        filename = self.path(url)
+        if not os.path.exists(filename):
+            return None
+        try:
+            with open(filename + CHECKSUM_SUFFIX, 'r') as file:
+                checksum, size = file.read().split()
+        except (OSError, ValueError):
+            checksum, size = None, None
+
+        if size is None or os.path.getsize(filename) != int(size) or file_checksum(filename) != checksum:
+            print(f"  {datetime.now()}: cached file {filename} is damaged, removing it")
+            self.remove(filename)
+            return None
+
+        # update modification time, eviction removes least recently used files first
+        os.utime(filename)
+        print(f"  {datetime.now()}: using cached file {filename}") if self.debug else None
+        return filename
+
+    def put(self, url, filename):
+        """
+        Moves downloaded file into the cache and returns its cache file name
+        """
+        cached_filename = self.path(url)
+        checksum = file_checksum(filename)
+        size = os.path.getsize(filename)
+        # checksum is published first, so concurrent get never sees the file without its checksum
+        checksum_filename = f"{filename}{CHECKSUM_SUFFIX}{PARTIAL_SUFFIX}"
+        with open(checksum_filename, 'w') as file:
+            file.write(f"{checksum} {size}\n")
+        os.replace(checksum_filename, cached_filename + CHECKSUM_SUFFIX)
+        os.replace(filename, cached_filename)
+        self.evict(keep=cached_filename)
+        return cached_filename
+
+    def fetch(self, url):
+        """
+        Returns cached file name for url, downloads the file if it is not cached
+        """
+        cached_filename = self.get(url)
+        if cached_filename:
+            return cached_filename
+        partial_filename = self.partial_filename(url)
+        try:
+            download_file(url, partial_filename)
+        except Exception:
+            if os.path.exists(partial_filename):
+                os.remove(partial_filename)
+            raise
+        return self.put(url, partial_filename)
+
+    def remove(self, filename):
+        """
+        Removes cached file and its checksum
+        """
+        for name in (filename, filename + CHECKSUM_SUFFIX):
+            try:
+                os.remove(name)
+            except FileNotFoundError:
+                pass
+
+    def evict(self, keep=None):
+        """
+        Removes least recently used files until the cache fits into max_size
+        """
+        if not self.max_size:
+            return
+        with self.lock:
+            entries = []
+            for name in os.listdir(self.directory):
+                filename = os.path.join(self.directory, name)
+                if name.endswith(CHECKSUM_SUFFIX) or name.endswith(PARTIAL_SUFFIX):
+                    continue
+                try:
+                    stats = os.stat(filename)
+                except FileNotFoundError:
+                    # evicted by other process sharing the cache
+                    continue
+                entries.append((stats.st_mtime, stats.st_size, filename))
+
+            total_size = sum(entry[1] for entry in entries)
+            for _, size, filename in sorted(entries):
+                if total_size <= self.max_size:
+                    break
+                if filename == keep or filename in self.pinned:
+                    continue
+                print(f"  {datetime.now()}: evicting cached file {filename}") if self.debug else None
+                self.remove(filename)
+                total_size -= size
@@ -0,0 +1,34 @@
+"""
+Helpers shared by Github archive loaders and their modules
+"""
+import os
+from datetime import datetime
+
+
+def timestamped_filename(filename, suffix=''):
+    """
+    Returns temporary file name for filename, timestamp makes it unique among concurrent writers
+    """
+    return f"{filename}.{datetime.now().strftime('%Y-%m-%d-%H-%M-%S-%f')}{suffix}"
+
+
+def sql_literal(value):
+    """
+    Returns value as SQL string literal
+    """
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def prepare_runtime_file(runtime_file, header, rewrite=False):
+    """
+    Creates runtime file with header, existing file is removed first if rewrite is set
+    Returns False if existing file has different header (columns of other version), rows must not be appended then
+    """
+    if rewrite and os.path.exists(runtime_file):
+        os.remove(runtime_file)
+    if not os.path.exists(runtime_file):
+        with open(runtime_file, 'w') as csv_file:
+            csv_file.write(header)
+        return True
+    with open(runtime_file, 'r') as csv_file:
+        return csv_file.readline() == header
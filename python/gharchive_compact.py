@@ -0,0 +1,277 @@
+"""
+Lossless compaction of derivable URL fields of Github archive events
+
+URL fields of actor, org, repo, users, issue and comment objects are built
+from ids, logins, repository name and issue number. Field is removed only
+when its value equals the URL built from the template, removed fields are
+recorded in bitmask stored under COMPACT_MARKER key of the object. Keys of
+the original document which could be taken for the marker (_u, __u, ...) get
+one more leading underscore, so only the marker is stored under _u. Original
+document is rebuilt by expand_event in Python or by SQL function created by
+expand_function_sql in PostgreSQL.
+"""
+import re
+
+COMPACT_MARKER = '_u'
+
+# keys escaped by compaction, marker with one or more additional leading underscores
+ESCAPED_MARKER = re.compile(r'^_+' + re.escape(COMPACT_MARKER) + '$')
+
+API = 'https://api.github.com'
+
+# values of placeholders taken from the event, not from the compacted object
+CONTEXT_PLACEHOLDERS = ('repo', 'issue_number')
+
+# (field, template) per object kind, bit of the field in the marker is its position in the list
+URL_TEMPLATES = {
+    'actor': [
+        ('url', API + '/users/%(login)s'),
+        ('avatar_url', 'https://avatars.githubusercontent.com/u/%(id)s?'),
+    ],
+    'org': [
+        ('url', API + '/orgs/%(login)s'),
+        ('avatar_url', 'https://avatars.githubusercontent.com/u/%(id)s?'),
+    ],
+    'repo': [
+        ('url', API + '/repos/%(name)s'),
+    ],
+    'user': [
+        ('url', API + '/users/%(login)s'),
+        ('html_url', 'https://github.com/%(login)s'),
+        ('followers_url', API + '/users/%(login)s/followers'),
+        ('following_url', API + '/users/%(login)s/following{/other_user}'),
+        ('gists_url', API + '/users/%(login)s/gists{/gist_id}'),
+        ('starred_url', API + '/users/%(login)s/starred{/owner}{/repo}'),
+        ('subscriptions_url', API + '/users/%(login)s/subscriptions'),
+        ('organizations_url', API + '/users/%(login)s/orgs'),
+        ('repos_url', API + '/users/%(login)s/repos'),
+        ('events_url', API + '/users/%(login)s/events{/privacy}'),
+        ('received_events_url', API + '/users/%(login)s/received_events'),
+        ('avatar_url', 'https://avatars.githubusercontent.com/u/%(id)s?v=4'),
+    ],
+    'issue': [
+        ('url', API + '/repos/%(repo)s/issues/%(number)s'),
+        ('repository_url', API + '/repos/%(repo)s'),
+        ('labels_url', API + '/repos/%(repo)s/issues/%(number)s/labels{/name}'),
+        ('comments_url', API + '/repos/%(repo)s/issues/%(number)s/comments'),
+        ('events_url', API + '/repos/%(repo)s/issues/%(number)s/events'),
+        ('html_url', 'https://github.com/%(repo)s/issues/%(number)s'),
+    ],
+    'comment': [
+        ('url', API + '/repos/%(repo)s/issues/comments/%(id)s'),
+        ('html_url', 'https://github.com/%(repo)s/issues/%(issue_number)s#issuecomment-%(id)s'),
+        ('issue_url', API + '/repos/%(repo)s/issues/%(issue_number)s'),
+    ],
+}
+
+PLACEHOLDER = re.compile(r'%\((\w+)\)s')
+
+
+def child_kind(kind, key):
+    """
+    Returns kind of nested object, objects nested in payload other than issue and comment are users
+    """
+    if kind == 'payload' and key in ('issue', 'comment'):
+        return key
+    return 'user'
+
+
+def placeholder_value(value):
+    """
+    Returns text of placeholder value as PostgreSQL ->> operator returns it, None if it can not be used
+    """
+    if isinstance(value, bool) or not isinstance(value, (str, int)):
+        return None
+    return str(value)
+
+
+def render(template, obj, context):
+    """
+    Returns URL built from template or None if some placeholder value is missing
+    """
+    values = {}
+    for name in PLACEHOLDER.findall(template):
+        value = placeholder_value(context.get(name) if name in CONTEXT_PLACEHOLDERS else obj.get(name))
+        if value is None:
+            return None
+        values[name] = value
+    return template % values
+
+
+def event_context(event):
+    """
+    Returns values of context placeholders of the event
+    """
+    repo = event.get('repo') if isinstance(event.get('repo'), dict) else {}
+    payload = event.get('payload') if isinstance(event.get('payload'), dict) else {}
+    issue = payload.get('issue') if isinstance(payload.get('issue'), dict) else {}
+    return {'repo': repo.get('name'), 'issue_number': issue.get('number')}
+
+
+def escape_keys(obj):
+    """
+    Returns object with keys which could be taken for the marker prefixed with underscore, key order is kept
+    """
+    if not any(key == COMPACT_MARKER or ESCAPED_MARKER.match(key) for key in obj):
+        return obj
+    return {('_' + key if key == COMPACT_MARKER or ESCAPED_MARKER.match(key) else key): value
+            for key, value in obj.items()}
+
+
+def unescape_keys(obj):
+    """
+    Returns object with keys escaped by escape_keys restored, key order is kept
+    """
+    if not any(ESCAPED_MARKER.match(key) for key in obj):
+        return obj
+    return {(key[1:] if ESCAPED_MARKER.match(key) else key): value for key, value in obj.items()}
+
+
+def compact_object(obj, kind, context):
+    """
+    Removes URL fields equal to their templates from the object and its nested objects
+    """
+    if isinstance(obj, list):
+        return [compact_object(item, 'user', context) for item in obj]
+    if not isinstance(obj, dict):
+        return obj
+    for key, value in obj.items():
+        if isinstance(value, (dict, list)):
+            obj[key] = compact_object(value, child_kind(kind, key), context)
+    mask = 0
+    for bit, (field, template) in enumerate(URL_TEMPLATES.get(kind, [])):
+        if field in obj and obj[field] == render(template, obj, context):
+            del obj[field]
+            mask |= 1 << bit
+    obj = escape_keys(obj)
+    if mask:
+        obj[COMPACT_MARKER] = mask
+    return obj
+
+
+def expand_object(obj, kind, context):
+    """
+    Restores URL fields removed by compact_object
+    """
+    if isinstance(obj, list):
+        return [expand_object(item, 'user', context) for item in obj]
+    if not isinstance(obj, dict):
+        return obj
+    for key, value in obj.items():
+        if isinstance(value, (dict, list)):
+            obj[key] = expand_object(value, child_kind(kind, key), context)
+    mask = obj.pop(COMPACT_MARKER, 0)
+    obj = unescape_keys(obj)
+    for bit, (field, template) in enumerate(URL_TEMPLATES.get(kind, [])):
+        if mask & (1 << bit):
+            obj[field] = render(template, obj, context)
+    return obj
+
+
+def compact_event(event):
+    """
+    Returns event without derivable URL fields
+    """
+    context = event_context(event)
+    for key in ('actor', 'org', 'repo', 'payload'):
+        if isinstance(event.get(key), dict):
+            event[key] = compact_object(event[key], key, context)
+    return event
+
+
+def expand_event(event):
+    """
+    Returns event with URL fields removed by compact_event
+    """
+    context = event_context(event)
+    for key in ('actor', 'org', 'repo', 'payload'):
+        if isinstance(event.get(key), dict):
+            event[key] = expand_object(event[key], key, context)
+    return event
+
+
+def sql_template(template):
+    """
+    Returns SQL expression building URL from template inside gharchive_expand_object
+    """
+    parts = []
+    for index, part in enumerate(PLACEHOLDER.split(template)):
+        if index % 2 == 0:
+            if part:
+                parts.append("'" + part.replace("'", "''") + "'")
+        elif part in CONTEXT_PLACEHOLDERS:
+            parts.append(part)
+        else:
+            parts.append(f"(obj->>'{part}')")
+    return ' || '.join(parts)
+
+
+def expand_function_sql(schema='public'):
+    """
+    Returns DDL of PostgreSQL function gharchive_expand(jsonb) restoring compacted events
+    """
+    branches = []
+    for kind, templates in URL_TEMPLATES.items():
+        fields = '\n'.join(
+            f"        IF (mask & {1 << bit}) <> 0 THEN\n"
+            f"            result := result || jsonb_build_object('{field}', {sql_template(template)});\n"
+            f"        END IF;"
+            for bit, (field, template) in enumerate(templates))
+        branches.append(f"    ELSIF kind = '{kind}' THEN\n{fields}")
+    branches = '\n'.join(branches).replace('    ELSIF', '    IF', 1)
+
+    return f"""
+CREATE OR REPLACE FUNCTION {schema}.gharchive_expand_object(obj jsonb, kind text, repo text, issue_number text)
+RETURNS jsonb LANGUAGE plpgsql IMMUTABLE AS $function$
+DECLARE
+    result jsonb := obj;
+    mask int;
+    child_key text;
+    child jsonb;
+BEGIN
+    IF jsonb_typeof(obj) = 'array' THEN
+        RETURN (SELECT coalesce(jsonb_agg({schema}.gharchive_expand_object(item, 'user', repo, issue_number)
+                                          ORDER BY position), '[]'::jsonb)
+                FROM jsonb_array_elements(obj) WITH ORDINALITY AS items(item, position));
+    END IF;
+    IF jsonb_typeof(obj) IS DISTINCT FROM 'object' THEN
+        RETURN obj;
+    END IF;
+    FOR child_key, child IN SELECT key, value FROM jsonb_each(obj) WHERE jsonb_typeof(value) IN ('object', 'array') LOOP
+        result := jsonb_set(result, ARRAY[child_key], {schema}.gharchive_expand_object(child,
+            CASE WHEN kind = 'payload' AND child_key IN ('issue', 'comment') THEN child_key ELSE 'user' END,
+            repo, issue_number));
+    END LOOP;
+    mask := coalesce((obj->>'{COMPACT_MARKER}')::int, 0);
+    result := result - '{COMPACT_MARKER}';
+    IF EXISTS (SELECT 1 FROM jsonb_object_keys(result) AS keys(key) WHERE key ~ '{ESCAPED_MARKER.pattern}') THEN
+        -- keys escaped by compaction
+        SELECT jsonb_object_agg(CASE WHEN key ~ '{ESCAPED_MARKER.pattern}' THEN substr(key, 2) ELSE key END, value)
+        INTO result FROM jsonb_each(result);
+    END IF;
+    IF mask = 0 THEN
+        RETURN result;
+    END IF;
+{branches}
+    END IF;
+    RETURN result;
+END
+$function$;
+
+CREATE OR REPLACE FUNCTION {schema}.gharchive_expand(doc jsonb)
+RETURNS jsonb LANGUAGE plpgsql IMMUTABLE AS $function$
+DECLARE
+    result jsonb := doc;
+    repo text := doc->'repo'->>'name';
+    issue_number text := doc->'payload'->'issue'->>'number';
+    key text;
+BEGIN
+    FOREACH key IN ARRAY ARRAY['actor', 'org', 'repo', 'payload'] LOOP
+        IF jsonb_typeof(doc->key) = 'object' THEN
+            result := jsonb_set(result, ARRAY[key], {schema}.gharchive_expand_object(doc->key, key, repo, issue_number));
+        END IF;
+    END LOOP;
+    RETURN result;
+END
+$function$;
+"""
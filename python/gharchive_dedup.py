@@ -0,0 +1,143 @@
+"""
+Deduplication of Github archive events by event id
+
+Ids of loaded events are kept in Bloom filter persisted in a file between
+runs. Event whose id is not in the filter is surely new and is loaded the
+usual way. Event whose id may be in the filter (suspected duplicate) is
+inserted with ON CONFLICT DO NOTHING against unique index on event id, so
+the database decides only for suspected events and false positives of the
+filter cost one insert, not a lost event.
+
+Filter is saved every few loaded hours and at the end of the run. Ids
+committed after the last save are missing in the filter after a crash,
+their events are then rejected by the unique index when they are loaded
+again, which costs a failed batch, not a duplicate.
+"""
+import hashlib
+import math
+import os
+import re
+import struct
+from gharchive_common import timestamped_filename
+from gharchive_events import loads
+
+# event id is the first key of events in Github archive
+EVENT_ID = re.compile(r'^\{"id"\s*:\s*"([^"\\]*)"')
+
+
+def event_id(row):
+    """
+    Returns id of serialized event or None if the event has no id
+    """
+    match = EVENT_ID.match(row)
+    if match:
+        return match.group(1)
+    value = loads(row).get('id')
+    return None if value is None else str(value)
+
+
+class BloomFilter:
+    """
+    Bloom filter of strings with double hashing of one blake2b digest
+    """
+    MAGIC = b'GHBLOOM1'
+    HEADER = struct.Struct('<8sQQQ')
+
+    def __init__(self, capacity, error_rate, size=None, hashes=None, count=0, bits=None):
+        # optimal number of bits and hash functions for capacity and error rate
+        self.size = size or max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.hashes = hashes or max(1, int(round(self.size / capacity * math.log(2))))
+        self.count = count
+        self.bits = bits if bits is not None else bytearray((self.size + 7) // 8)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Reads filter saved by save
+        """
+        with open(filename, 'rb') as file:
+            magic, size, hashes, count = cls.HEADER.unpack(file.read(cls.HEADER.size))
+            if magic != cls.MAGIC:
+                raise ValueError(f"{filename} is not a Bloom filter file")
+            bits = bytearray(file.read())
+        if len(bits) != (size + 7) // 8:
+            raise ValueError(f"Bloom filter file {filename} is truncated")
+        return cls(0, 0, size, hashes, count, bits)
+
+    def save(self, filename):
+        """
+        Writes filter into file, old file is replaced only when the new one is complete and on disk
+        """
+        temporary_filename = timestamped_filename(filename)
+        with open(temporary_filename, 'wb') as file:
+            file.write(self.HEADER.pack(self.MAGIC, self.size, self.hashes, self.count))
+            file.write(self.bits)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_filename, filename)
+
+    def positions(self, key):
+        """
+        Returns bit positions of key
+        """
+        first, second = struct.unpack('<QQ', hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest())
+        return [(first + index * second) % self.size for index in range(self.hashes)]
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(key))
+
+    def add(self, key):
+        """
+        Adds key, returns True if the key was possibly added before
+        """
+        present = True
+        for position in self.positions(key):
+            mask = 1 << (position & 7)
+            if not self.bits[position >> 3] & mask:
+                present = False
+                self.bits[position >> 3] |= mask
+        if not present:
+            self.count += 1
+        return present
+
+
+class EventIdFilter:
+    """
+    Bloom filter of loaded event ids stored in file between runs, saved after every save_hours loaded hours
+    """
+
+    def __init__(self, filename, capacity, error_rate, save_hours=24):
+        self.filename = filename
+        self.save_hours = save_hours
+        self.unsaved_hours = 0
+        if os.path.exists(filename):
+            self.bloom = BloomFilter.load(filename)
+            print(f"Event id filter {filename}: {self.bloom.count} ids, {self.bloom.size // 8 // 1024 // 1024} MB")
+        else:
+            self.bloom = BloomFilter(capacity, error_rate)
+            print(f"Event id filter {filename}: new, {self.bloom.size // 8 // 1024 // 1024} MB")
+        if self.bloom.count > capacity:
+            print(f"WARNING: event id filter holds {self.bloom.count} ids, more than capacity {capacity}, "
+                  "more events will be checked by the database")
+
+    def suspected(self, row):
+        """
+        Registers id of the event, returns True if the event may have been loaded already
+        """
+        key = event_id(row)
+        return key is not None and self.bloom.add(key)
+
+    def hour_loaded(self):
+        """
+        Registers committed hour, saves the filter when save_hours hours were loaded since the last save
+        """
+        self.unsaved_hours += 1
+        if self.unsaved_hours >= self.save_hours:
+            self.save()
+
+    def save(self):
+        """
+        Persists the filter
+        """
+        self.bloom.save(self.filename)
+        self.unsaved_hours = 0
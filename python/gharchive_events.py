@@ -0,0 +1,246 @@
+"""
+Serialization of Github archive events for loading into the database
+
+Lines which are loaded as they are (fast path) are only sanitized on byte
+level, they are never decoded into Python objects. Lines are decoded and
+encoded again only when a transformation needs the parsed event (slow path).
+orjson is used for the slow path when it is installed.
+"""
+import json
+import random
+import re
+from gharchive_compact import compact_event
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSON_LIBRARY = 'orjson' if orjson else 'json'
+
+# \u0000 escape not preceded by another backslash, PostgreSQL JSONB does not accept it
+NUL_ESCAPE = re.compile(rb'(?<!\\)((?:\\\\)*)\\u0000')
+
+# type is the second key of events in Github archive, after id
+EVENT_TYPE = re.compile(r'^\{(?:"id"\s*:\s*"[^"\\]*"\s*,\s*)?"type"\s*:\s*"([^"\\]*)"')
+
+
+def sanitize(line):
+    """
+    Returns JSON line as string without \\u0000 escapes and with backticks replaced by quotes
+    """
+    line = line.rstrip(b'\r\n')
+    if b'\\u0000' in line:
+        line = NUL_ESCAPE.sub(rb'\1', line)
+    return line.replace(b'`', b"'").decode('utf-8')
+
+
+def loads(line):
+    """
+    Parses JSON line
+    """
+    if orjson:
+        try:
+            return orjson.loads(line)
+        except orjson.JSONDecodeError:
+            # orjson does not support integers over 64 bits, json module does
+            pass
+    return json.loads(line)
+
+
+def dumps(event):
+    """
+    Returns event serialized as UTF-8 encoded JSON
+    """
+    if orjson:
+        try:
+            return orjson.dumps(event)
+        except orjson.JSONEncodeError:
+            pass
+    try:
+        return json.dumps(event, ensure_ascii=False).encode('utf-8')
+    except UnicodeEncodeError:
+        # lone surrogates (e.g. "\\ud800") cannot be encoded into UTF-8, they are kept escaped
+        return json.dumps(event).encode('ascii')
+
+
+def event_type(row):
+    """
+    Returns type of serialized event or None if the event has no type
+    Type is read from the start of the row, row is parsed only when type is not there
+    """
+    match = EVENT_TYPE.match(row)
+    if match:
+        return match.group(1)
+    value = loads(row).get('type')
+    return value if isinstance(value, str) else None
+
+
+def serialize_line(line, transform=None, position=None):
+    """
+    Returns raw line as JSON string ready for load, empty string if the event is filtered out
+    If transform is set, it gets parsed event and position of the line (hour, line index) and returns
+    changed event or None, otherwise line is not parsed at all
+    Lines rejected by prefilter of the transform are not parsed either
+    """
+    if transform is None:
+        return sanitize(line)
+    prefilter = getattr(transform, 'prefilter', None)
+    if prefilter is not None and not prefilter(line):
+        return ''
+    event = transform(loads(line), position)
+    if event is None:
+        return ''
+    return sanitize(dumps(event))
+
+
+class RandomKeyDropper:
+    """
+    Drops random keys from events, reproducibly when seed is set
+
+    Drop decisions are generated for batches of batch_size lines from random
+    stream seeded by seed, hour and batch number, so the same line of the same
+    hour always loses the same keys, regardless of order in which lines are
+    processed (parallel workers, transform processes, resumed load).
+    Decision is number of keys to drop (min_keys..max_keys) and random numbers
+    choosing them among candidate keys of the event: keys from keys list (all
+    keys if it is empty) of the event and of nested objects up to depth.
+    """
+
+    def __init__(self, seed=None, keys=None, min_keys=1, max_keys=3, depth=1, batch_size=4096):
+        # without seed decisions are random, but still generated in batches
+        self.seed = seed if seed is not None else random.SystemRandom().getrandbits(64)
+        self.keys = set(keys or [])
+        self.min_keys = min_keys
+        self.max_keys = max_keys
+        self.depth = depth
+        self.batch_size = batch_size
+        self.batch_key = None
+        self.counts = []
+        self.choices = []
+
+    def decision(self, position):
+        """
+        Returns number of keys to drop and random numbers choosing them for line at position (hour, line index)
+        """
+        unit, index = position if position is not None else (None, 0)
+        batch, offset = divmod(index, self.batch_size)
+        if self.batch_key != (unit, batch):
+            stream = random.Random(f"{self.seed}:{unit}:{batch}")
+            self.counts = [stream.randint(self.min_keys, self.max_keys) for _ in range(self.batch_size)]
+            self.choices = [stream.random() for _ in range(self.batch_size * self.max_keys)]
+            self.batch_key = (unit, batch)
+        return self.counts[offset], self.choices[offset * self.max_keys:(offset + 1) * self.max_keys]
+
+    def candidates(self, obj, path=(), level=1):
+        """
+        Returns paths of keys which can be dropped
+        """
+        paths = []
+        for key, value in obj.items():
+            if not self.keys or key in self.keys:
+                paths.append(path + (key, ))
+            if level < self.depth and isinstance(value, dict):
+                paths += self.candidates(value, path + (key, ), level + 1)
+        return paths
+
+    def __call__(self, event, position=None):
+        """
+        Drops keys from event, returns the event
+        """
+        count, choices = self.decision(position)
+        candidates = self.candidates(event)
+        for choice in choices[:min(count, len(candidates))]:
+            path = candidates.pop(int(choice * len(candidates)))
+            parent = event
+            for key in path[:-1]:
+                parent = parent.get(key) if isinstance(parent, dict) else None
+            # parent could have been dropped before
+            if isinstance(parent, dict):
+                parent.pop(path[-1], None)
+        return event
+
+
+def project(event, paths):
+    """
+    Returns document with only the paths of the event, path is tuple of keys of nested objects
+    """
+    result = {}
+    for path in paths:
+        value = event
+        for key in path:
+            if not isinstance(value, dict) or key not in value:
+                break
+            value = value[key]
+        else:
+            target = result
+            for key in path[:-1]:
+                target = target.setdefault(key, {})
+            target[path[-1]] = value
+    return result
+
+
+class EventTransform:
+    """
+    Filters events by type and repository, drops random keys, projects paths
+    and removes derivable URL fields
+
+    Byte level prefilter rejects lines which can not match the filters before
+    they are parsed, matching lines are checked exactly after parse.
+    """
+
+    def __init__(self, include_types=None, include_repos=None, project_paths=None, random_drop=None,
+                 compact_urls=False):
+        self.include_types = set(include_types or [])
+        self.include_repos = set(include_repos or [])
+        self.project_paths = [tuple(path.split('.')) for path in project_paths or []]
+        self.random_drop = random_drop
+        self.compact_urls = compact_urls
+        self.type_pattern = None
+        if self.include_types:
+            types = b'|'.join(re.escape(name.encode('utf-8')) for name in sorted(self.include_types))
+            self.type_pattern = re.compile(rb'"type"\s*:\s*"(?:' + types + rb')"')
+        # repository name can have escaped slash in JSON
+        self.repo_needles = [needle for name in sorted(self.include_repos)
+                             for needle in (name.encode('utf-8'), name.replace('/', '\\/').encode('utf-8'))]
+
+    def prefilter(self, line):
+        """
+        Returns False if raw line can not match the filters
+        """
+        if self.type_pattern is not None and not self.type_pattern.search(line):
+            return False
+        if self.repo_needles and not any(needle in line for needle in self.repo_needles):
+            return False
+        return True
+
+    def __call__(self, event, position=None):
+        """
+        Returns transformed event or None if the event does not match the filters
+        """
+        if self.include_types and event.get('type') not in self.include_types:
+            return None
+        if self.include_repos and (event.get('repo') or {}).get('name') not in self.include_repos:
+            return None
+        if self.random_drop:
+            event = self.random_drop(event, position)
+        if self.project_paths:
+            event = project(event, self.project_paths)
+        if self.compact_urls:
+            event = compact_event(event)
+        return event
+
+
+def build_transform(args):
+    """
+    Returns transform for command line options of the loader or None when events are loaded
+    as they are (fast path)
+    """
+    random_drop = None
+    if args.random_drop:
+        random_drop = RandomKeyDropper(args.random_drop_seed, args.random_drop_keys, args.random_drop_min,
+                                       args.random_drop_max, args.random_drop_depth)
+    compact_urls = getattr(args, 'compact_urls', False)
+    if not args.include_types and not args.include_repos and not args.project and not random_drop and not compact_urls:
+        return None
+    return EventTransform(args.include_types, args.include_repos, args.project, random_drop, compact_urls)
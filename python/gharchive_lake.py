@@ -0,0 +1,514 @@
+"""
+Parquet lake of Github archive events partitioned by date, hour and event type
+
+Each hour is written as one Parquet file per event type under
+<lake_dir>/date=YYYY-MM-DD/hour=HH/type=<type>/. Common fields of events are
+stored in their own columns (actor, repo and org as id and login/name), so
+scans read only the columns they need, payload is kept as JSON string.
+Partition values are not stored in the files. Compaction merges hourly files
+of a day into one file per type under hour=all.
+
+Statistics of each file (rows, created_at and repo id range, event types) are
+recorded in NDJSON manifest in the lake directory when the file is written.
+Queries get only files which can match their time range, types and repos,
+so DuckDB does not list the lake and read footers of all files.
+
+Usage:
+    python gharchive_lake.py compact --lake_dir lake [--date 2023-01-01 ...]
+    python gharchive_lake.py query --lake_dir lake [--start 2023-01-01T10:00:00] [--end ...] [--types PushEvent]
+                                   [--repo_ids 123] "SELECT type, count(*) FROM events GROUP BY 1"
+    python gharchive_lake.py manifest --lake_dir lake
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+from datetime import datetime, timezone
+from gharchive_common import sql_literal, timestamped_filename
+from gharchive_events import dumps, loads
+
+try:
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+# hour partition of files compacted into whole day
+COMPACTED_HOUR = 'all'
+
+# key of schema metadata of daily file with row range (offset, rows) of each source hour
+HOURS_METADATA = b'gharchive_hours'
+
+# file statistics of the lake, relative to lake directory
+MANIFEST_FILE = '_manifest.ndjson'
+
+# SQL types of columns for empty events view
+SQL_TYPES = {'string': 'VARCHAR', 'timestamp': 'TIMESTAMPTZ', 'bool': 'BOOLEAN', 'int64': 'BIGINT', 'json': 'VARCHAR'}
+
+# (column, path in event, arrow type name), payload is stored as JSON string
+COLUMNS = [
+    ('id', ('id', ), 'string'),
+    ('created_at', ('created_at', ), 'timestamp'),
+    ('public', ('public', ), 'bool'),
+    ('actor_id', ('actor', 'id'), 'int64'),
+    ('actor_login', ('actor', 'login'), 'string'),
+    ('repo_id', ('repo', 'id'), 'int64'),
+    ('repo_name', ('repo', 'name'), 'string'),
+    ('org_id', ('org', 'id'), 'int64'),
+    ('org_login', ('org', 'login'), 'string'),
+    ('payload', ('payload', ), 'json'),
+]
+
+
+def arrow_type(name):
+    """
+    Returns arrow type of column type name
+    """
+    if name == 'timestamp':
+        # Parquet has no seconds unit, files are read back with milliseconds
+        return pyarrow.timestamp('ms', tz='UTC')
+    if name == 'json':
+        return pyarrow.string()
+    if name == 'bool':
+        return pyarrow.bool_()
+    return getattr(pyarrow, name)()
+
+
+def arrow_schema():
+    """
+    Returns schema of lake files
+    """
+    return pyarrow.schema([(column, arrow_type(type_name)) for column, _, type_name in COLUMNS])
+
+
+def column_value(event, path, type_name):
+    """
+    Returns value of the column from parsed event, None if it is missing or has wrong type
+    """
+    value = event
+    for key in path:
+        value = value.get(key) if isinstance(value, dict) else None
+    if value is None:
+        return None
+    if type_name == 'json':
+        return dumps(value).decode('utf-8')
+    if type_name == 'int64':
+        return value if isinstance(value, int) and not isinstance(value, bool) else None
+    if type_name == 'bool':
+        return value if isinstance(value, bool) else None
+    if type_name == 'timestamp':
+        try:
+            return datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except (AttributeError, ValueError):
+            return None
+    return str(value)
+
+
+def partition_dir(lake_dir, date, hour, event_type):
+    """
+    Returns directory of the partition
+    """
+    return os.path.join(lake_dir, f"date={date}", f"hour={hour}", f"type={event_type}")
+
+
+def write_table(table, filename, row_group_rows, compression):
+    """
+    Writes arrow table into Parquet file, existing file is replaced only when the new one is complete
+    """
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    temporary_filename = timestamped_filename(filename, '.part')
+    pyarrow.parquet.write_table(table, temporary_filename, row_group_size=row_group_rows,
+                                compression=None if compression == 'none' else compression)
+    os.replace(temporary_filename, filename)
+    return os.path.getsize(filename)
+
+
+def file_stats(table, event_type):
+    """
+    Returns manifest statistics of arrow table written into lake file of the event type
+    """
+    created_at = pyarrow.compute.min_max(table['created_at']).as_py()
+    repo_ids = pyarrow.compute.min_max(table['repo_id']).as_py()
+    return {
+        'rows': table.num_rows,
+        'min_created_at': created_at['min'].isoformat() if created_at['min'] else None,
+        'max_created_at': created_at['max'].isoformat() if created_at['max'] else None,
+        'types': [event_type],
+        'min_repo_id': repo_ids['min'],
+        'max_repo_id': repo_ids['max'],
+    }
+
+
+def parse_time(value):
+    """
+    Returns datetime of ISO time, time without zone is UTC
+    """
+    time = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    return time if time.tzinfo else time.replace(tzinfo=timezone.utc)
+
+
+class LakeManifest:
+    """
+    Statistics of lake files in NDJSON file, one JSON object per line
+
+    Writes append lines, later line of the same path replaces the earlier one
+    and line with removed set drops the file. Compaction rewrites the manifest
+    with one line per existing file. Files without statistics (null values)
+    are never pruned.
+    """
+
+    def __init__(self, lake_dir):
+        self.lake_dir = lake_dir
+        self.filename = os.path.join(lake_dir, MANIFEST_FILE)
+
+    def exists(self):
+        """
+        Returns True if the lake has manifest
+        """
+        return os.path.exists(self.filename)
+
+    def add(self, filename, stats):
+        """
+        Records statistics of written file
+        """
+        entry = dict(path=os.path.relpath(filename, self.lake_dir), bytes=os.path.getsize(filename), **stats)
+        self.append([entry])
+
+    def remove(self, filenames):
+        """
+        Records removed files
+        """
+        self.append([{'path': os.path.relpath(filename, self.lake_dir), 'removed': True} for filename in filenames])
+
+    def append(self, entries):
+        """
+        Appends lines to the manifest
+        """
+        os.makedirs(self.lake_dir, exist_ok=True)
+        with open(self.filename, 'a') as file:
+            file.write(''.join(json.dumps(entry) + '\n' for entry in entries))
+
+    def files(self):
+        """
+        Returns statistics of existing files by path
+        """
+        files = {}
+        if not self.exists():
+            return files
+        with open(self.filename, 'r') as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if entry.get('removed'):
+                    files.pop(entry['path'], None)
+                else:
+                    files[entry['path']] = entry
+        return files
+
+    def write(self, files):
+        """
+        Replaces the manifest with statistics of the files
+        """
+        temporary_filename = timestamped_filename(self.filename, '.part')
+        with open(temporary_filename, 'w') as file:
+            file.write(''.join(json.dumps(entry) + '\n' for _, entry in sorted(files.items())))
+        os.replace(temporary_filename, self.filename)
+
+    def select(self, start=None, end=None, types=None, repo_ids=None):
+        """
+        Returns paths of files which can contain events created between start and end (datetimes, inclusive)
+        of the types and repositories
+        """
+        selected = []
+        for path, entry in sorted(self.files().items()):
+            if start and entry['max_created_at'] and parse_time(entry['max_created_at']) < start:
+                continue
+            if end and entry['min_created_at'] and parse_time(entry['min_created_at']) > end:
+                continue
+            if types and entry['types'] is not None and not set(entry['types']) & set(types):
+                continue
+            if repo_ids and entry['min_repo_id'] is not None and not any(
+                    entry['min_repo_id'] <= repo_id <= entry['max_repo_id'] for repo_id in repo_ids):
+                continue
+            selected.append(path)
+        return selected
+
+
+def rebuild_manifest(lake_dir):
+    """
+    Writes manifest with statistics read from all files of the lake, for lakes written without manifest
+    """
+    manifest = LakeManifest(lake_dir)
+    files = {}
+    for directory, _, names in os.walk(lake_dir):
+        for name in sorted(names):
+            if not name.endswith('.parquet'):
+                continue
+            filename = os.path.join(directory, name)
+            table = pyarrow.parquet.read_table(filename, columns=['created_at', 'repo_id'])
+            event_type = os.path.basename(directory).split('=', 1)[1]
+            path = os.path.relpath(filename, lake_dir)
+            files[path] = dict(path=path, bytes=os.path.getsize(filename), **file_stats(table, event_type))
+    manifest.write(files)
+    print(f"{datetime.now()}: manifest of {len(files)} files written")
+    return len(files)
+
+
+class LakeWriter:
+    """
+    Collects rows of one hourly file by event type and writes them as Parquet files on close
+
+    Loading the same hour again replaces its files, after compaction of the day
+    the next compaction replaces rows of the hour in the daily file. Rows are
+    sorted by created_at within each hourly file, so row group statistics prune time ranges.
+    """
+
+    def __init__(self, lake_dir, date_str, row_group_rows=128 * 1024, compression='zstd'):
+        self.lake_dir = lake_dir
+        # date_str is YYYY-MM-DD-HH
+        self.date = date_str[:10]
+        self.hour = date_str[11:13]
+        self.name = f"{date_str}.parquet"
+        self.row_group_rows = row_group_rows
+        self.compression = compression
+        self.columns = {}
+        self.errors = 0
+        self.bytes = 0
+        self.files = []
+        self.manifest = LakeManifest(lake_dir)
+
+    def write(self, event_str):
+        """
+        Adds one row to columns of its event type
+        """
+        try:
+            event = loads(event_str)
+        except ValueError as error:
+            print(f" {datetime.now()}: Skipping row, Error: {error}")
+            self.errors += 1
+            return None
+        event_type = event.get('type') if isinstance(event.get('type'), str) else 'untyped'
+        columns = self.columns.get(event_type)
+        if columns is None:
+            columns = self.columns[event_type] = [[] for _ in COLUMNS]
+        for values, (_, path, type_name) in zip(columns, COLUMNS):
+            values.append(column_value(event, path, type_name))
+        return None
+
+    def close(self):
+        """
+        Writes collected rows, one file for each event type
+        """
+        if not self.manifest.exists() and lake_dates(self.lake_dir):
+            # lake written before manifest was introduced, its files must not be missing from the manifest
+            rebuild_manifest(self.lake_dir)
+        schema = arrow_schema()
+        for event_type, columns in sorted(self.columns.items()):
+            table = pyarrow.Table.from_arrays(
+                [pyarrow.array(values, field.type) for values, field in zip(columns, schema)], schema=schema)
+            table = table.sort_by('created_at')
+            filename = os.path.join(partition_dir(self.lake_dir, self.date, self.hour, event_type), self.name)
+            self.bytes += write_table(table, filename, self.row_group_rows, self.compression)
+            self.manifest.add(filename, file_stats(table, event_type))
+            self.files.append(filename)
+        print(f"  {datetime.now()}: lake files written: {len(self.files)}, size: {self.bytes}")
+        self.columns = {}
+
+
+def lake_dates(lake_dir):
+    """
+    Returns dates which have partitions in the lake
+    """
+    if not os.path.isdir(lake_dir):
+        return []
+    return sorted(name.split('=', 1)[1] for name in os.listdir(lake_dir) if name.startswith('date='))
+
+
+def merge_hours(target, hourly):
+    """
+    Returns daily table of rows of daily file target (if it exists) and of hourly files
+    Rows are ordered by hour, row range of each hour is kept in schema metadata of the table
+    """
+    parts = {}
+    if os.path.exists(target):
+        daily = pyarrow.parquet.read_table(target, schema=arrow_schema())
+        metadata = pyarrow.parquet.read_schema(target).metadata or {}
+        # daily file without hour ranges is kept as one part
+        hours = json.loads(metadata[HOURS_METADATA]) if HOURS_METADATA in metadata else {'': [0, daily.num_rows]}
+        for hour, (offset, rows) in hours.items():
+            parts[hour] = daily.slice(offset, rows)
+    for filename in hourly:
+        # hourly file is in <date>/hour=HH/type=<type>/, it replaces rows of the hour from previous compaction
+        hour = os.path.basename(os.path.dirname(os.path.dirname(filename))).split('=', 1)[1]
+        parts[hour] = pyarrow.parquet.read_table(filename, schema=arrow_schema()).sort_by('created_at')
+
+    hours = {}
+    offset = 0
+    for hour, part in sorted(parts.items()):
+        hours[hour] = [offset, part.num_rows]
+        offset += part.num_rows
+    table = pyarrow.concat_tables([part for _, part in sorted(parts.items())])
+    return table.replace_schema_metadata({HOURS_METADATA: json.dumps(hours)})
+
+
+def compact_date(lake_dir, date, row_group_rows=128 * 1024, compression='zstd'):
+    """
+    Merges hourly files of the date into one file per event type under hour=all, returns number of merged files
+    Already compacted file of the date is merged too, so hours loaded later can be compacted again, rows of
+    hour loaded again after compaction replace rows of the hour in the daily file
+    Manifest gets statistics of daily files and hourly files are recorded as removed
+    """
+    manifest = LakeManifest(lake_dir)
+    if not manifest.exists():
+        # lake written before manifest, the manifest must list all dates before compaction adds the first file
+        rebuild_manifest(lake_dir)
+    date_dir = os.path.join(lake_dir, f"date={date}")
+    sources = {}
+    for hour_name in sorted(os.listdir(date_dir)):
+        hour_dir = os.path.join(date_dir, hour_name)
+        for type_name in sorted(os.listdir(hour_dir)):
+            type_dir = os.path.join(hour_dir, type_name)
+            sources.setdefault(type_name.split('=', 1)[1], []).extend(
+                os.path.join(type_dir, name) for name in sorted(os.listdir(type_dir)) if name.endswith('.parquet'))
+
+    merged = 0
+    for event_type, filenames in sorted(sources.items()):
+        target = os.path.join(partition_dir(lake_dir, date, COMPACTED_HOUR, event_type), f"{date}.parquet")
+        hourly = [filename for filename in filenames if filename != target]
+        if not hourly:
+            continue
+        table = merge_hours(target, hourly)
+        write_table(table, target, row_group_rows, compression)
+        manifest.add(target, file_stats(table, event_type))
+        for filename in hourly:
+            os.remove(filename)
+        manifest.remove(hourly)
+        merged += len(hourly)
+
+    # remove empty partitions of compacted hours
+    for hour_name in os.listdir(date_dir):
+        hour_dir = os.path.join(date_dir, hour_name)
+        if hour_name != f"hour={COMPACTED_HOUR}" and not any(files for _, _, files in os.walk(hour_dir)):
+            shutil.rmtree(hour_dir)
+    print(f"{datetime.now()}: date {date}: {merged} files compacted into {len(sources)} daily files")
+    return merged
+
+
+def lake_relation(lake_dir, files=None):
+    """
+    Returns DuckDB relation reading files of the lake (all files if files is None) with partition columns
+    """
+    if files == []:
+        # read_parquet needs at least one file
+        columns = [f"NULL::{SQL_TYPES[type_name]} AS {column}" for column, _, type_name in COLUMNS]
+        columns += ["NULL::DATE AS date", "NULL::VARCHAR AS hour", "NULL::VARCHAR AS type"]
+        return f"(SELECT {', '.join(columns)} WHERE false)"
+    if files is None:
+        source = sql_literal(os.path.join(lake_dir, 'date=*', 'hour=*', 'type=*', '*.parquet'))
+    else:
+        source = f"[{', '.join(sql_literal(os.path.join(lake_dir, path)) for path in files)}]"
+    # hour is text, compacted files have hour=all
+    return (f"read_parquet({source}, hive_partitioning = true, "
+            f"hive_types = {{'date': DATE, 'hour': VARCHAR, 'type': VARCHAR}})")
+
+
+def query_lake(lake_dir, query, conn=None, start=None, end=None, types=None, repo_ids=None):
+    """
+    Runs query on view events over the lake, returns column names and rows
+    View has only events created between start and end (datetimes, inclusive) of the types and repositories,
+    with manifest DuckDB reads only files which can contain them
+    """
+    conn = conn or duckdb.connect()
+    files = None
+    manifest = LakeManifest(lake_dir)
+    if manifest.exists():
+        files = manifest.select(start, end, types, repo_ids)
+        print(f"{datetime.now()}: manifest selected {len(files)} files")
+    conditions = []
+    if start:
+        conditions.append(f"created_at >= {sql_literal(start.isoformat())}::TIMESTAMPTZ")
+    if end:
+        conditions.append(f"created_at <= {sql_literal(end.isoformat())}::TIMESTAMPTZ")
+    if types:
+        conditions.append(f"type IN ({', '.join(sql_literal(name) for name in types)})")
+    if repo_ids:
+        conditions.append(f"repo_id IN ({', '.join(str(int(repo_id)) for repo_id in repo_ids)})")
+    view = f"CREATE OR REPLACE TEMPORARY VIEW events AS SELECT * FROM {lake_relation(lake_dir, files)}"
+    if conditions:
+        view += f" WHERE {' AND '.join(conditions)}"
+    conn.execute(view)
+    result = conn.execute(query)
+    return [column[0] for column in result.description], result.fetchall()
+
+
+def parse_input():
+    """
+    Parses command line arguments
+    """
+    parser = argparse.ArgumentParser(description='Compact and query Parquet lake of Github archive events')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    compact = commands.add_parser('compact', help='Merge hourly files into daily files')
+    compact.add_argument('-l', '--lake_dir', required=True, help='Directory of the lake')
+    compact.add_argument('--date', nargs='+', help='Dates (YYYY-MM-DD) to compact, all dates if not set')
+    compact.add_argument('--row_group_rows', type=int, default=128 * 1024, help='Rows in one row group')
+    compact.add_argument('--compression', default='zstd', help='Parquet compression, e.g. zstd, snappy, gzip, none')
+
+    query = commands.add_parser('query', help='Run SQL query on view events over the lake with DuckDB')
+    query.add_argument('-l', '--lake_dir', required=True, help='Directory of the lake')
+    query.add_argument('--start', help='View has only events created at or after this time (ISO, UTC)')
+    query.add_argument('--end', help='View has only events created at or before this time (ISO, UTC)')
+    query.add_argument('--types', nargs='+', help='View has only events of these types')
+    query.add_argument('--repo_ids', type=int, nargs='+', help='View has only events of these repository ids')
+    query.add_argument('query', help='SQL query, lake is available as view events')
+
+    manifest = commands.add_parser('manifest', help='Rebuild manifest from all files of the lake')
+    manifest.add_argument('-l', '--lake_dir', required=True, help='Directory of the lake')
+
+    return parser.parse_args()
+
+
+def main():
+    """
+    Main function
+    """
+    args = parse_input()
+    if args.command == 'compact':
+        if pyarrow is None:
+            print("ERROR: Compaction needs pyarrow!")
+            sys.exit(1)
+        for date in args.date or lake_dates(args.lake_dir):
+            compact_date(args.lake_dir, date, args.row_group_rows, args.compression)
+        manifest = LakeManifest(args.lake_dir)
+        if manifest.exists():
+            # one line per file instead of log of replaced and removed files
+            manifest.write(manifest.files())
+    elif args.command == 'manifest':
+        if pyarrow is None:
+            print("ERROR: Manifest rebuild needs pyarrow!")
+            sys.exit(1)
+        rebuild_manifest(args.lake_dir)
+    else:
+        if duckdb is None:
+            print("ERROR: Queries need duckdb!")
+            sys.exit(1)
+        start = datetime.now()
+        columns, rows = query_lake(args.lake_dir, args.query, start=parse_time(args.start) if args.start else None,
+                                   end=parse_time(args.end) if args.end else None, types=args.types,
+                                   repo_ids=args.repo_ids)
+        print(','.join(columns))
+        for row in rows:
+            print(','.join('' if value is None else str(value) for value in row))
+        print(f"{len(rows)} rows in {datetime.now() - start}")
+
+
+if __name__ == "__main__":
+    main()
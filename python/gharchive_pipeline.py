@@ -0,0 +1,201 @@
+"""
+Staged load pipeline for Github archive hourly files
+
+Reading of compressed data, decompression, serialization of events and
+writing into the database run as separate stages connected by bounded
+queues. Stages run concurrently in their own threads (network reads, zlib
+and database calls release the GIL), transformer stage can use process pool.
+Each queue is bounded by number of chunks and by its share of the memory
+budget, a stage which is faster than the next one waits (backpressure).
+"""
+import itertools
+import threading
+from collections import deque
+from datetime import datetime
+from gharchive_stream import iter_gzip_lines
+from gharchive_transform import serialize_lines
+
+# marks end of data in stage queue
+END = object()
+
+
+class PipelineCancelled(Exception):
+    """
+    Raised in stage threads when the pipeline was closed before all data were processed
+    """
+
+
+class StageQueue:
+    """
+    Queue between two stages bounded by number of chunks and their size in bytes
+
+    Chunk bigger than max_bytes is accepted when the queue is empty, so the
+    pipeline can not get stuck on one big chunk.
+    """
+
+    def __init__(self, name, max_chunks, max_bytes):
+        self.name = name
+        self.max_chunks = max_chunks
+        self.max_bytes = max_bytes
+        self.condition = threading.Condition()
+        self.chunks = deque()
+        self.size = 0
+        self.cancelled = False
+        # number of puts which had to wait for the next stage
+        self.waits = 0
+
+    def put(self, chunk, size=0):
+        """
+        Adds chunk to the queue, waits while the queue is full
+        """
+        with self.condition:
+            if self.chunks and (len(self.chunks) >= self.max_chunks or self.size + size > self.max_bytes):
+                self.waits += 1
+            while (self.chunks and not self.cancelled and
+                   (len(self.chunks) >= self.max_chunks or self.size + size > self.max_bytes)):
+                self.condition.wait()
+            if self.cancelled:
+                raise PipelineCancelled()
+            self.chunks.append((chunk, size))
+            self.size += size
+            self.condition.notify_all()
+
+    def put_error(self, error):
+        """
+        Passes error of the stage to the next stage regardless of queue limits
+        """
+        with self.condition:
+            self.chunks.append((error, 0))
+            self.condition.notify_all()
+
+    def get(self):
+        """
+        Removes and returns next chunk, waits while the queue is empty
+        """
+        with self.condition:
+            while not self.chunks:
+                if self.cancelled:
+                    raise PipelineCancelled()
+                self.condition.wait()
+            chunk, size = self.chunks.popleft()
+            self.size -= size
+            self.condition.notify_all()
+        if isinstance(chunk, BaseException):
+            raise chunk
+        return chunk
+
+    def __iter__(self):
+        while True:
+            chunk = self.get()
+            if chunk is END:
+                return
+            yield chunk
+
+    def cancel(self):
+        """
+        Wakes up and stops stages waiting on the queue
+        """
+        with self.condition:
+            self.cancelled = True
+            self.condition.notify_all()
+
+
+class LoadPipeline:
+    """
+    Runs reader, decoder and transformer stages of one hourly file in threads
+
+    Writer stage is the caller iterating rows(). Memory budget is split evenly
+    between the three queues. Rows are returned in the order of source lines,
+    unless transform pool was created as unordered.
+    """
+
+    def __init__(self, chunks, transform=None, transform_pool=None, memory_budget=512 * 1024 * 1024,
+                 chunk_lines=10000, max_chunks=64, skip_lines=0, decompressor='auto', stats=None, unit=None):
+        self.transform = transform
+        self.unit = unit
+        self.decompressor = decompressor
+        self.stats = stats
+        self.transform_pool = transform_pool
+        self.chunk_lines = chunk_lines
+        self.skip_lines = skip_lines
+        self.queues = [StageQueue(name, max_chunks, memory_budget // 3)
+                       for name in ('compressed', 'decoded', 'serialized')]
+        self.threads = [
+            threading.Thread(target=self.run_stage, args=(self.read, chunks, self.queues[0]), daemon=True),
+            threading.Thread(target=self.run_stage, args=(self.decode, self.queues[0], self.queues[1]), daemon=True),
+            threading.Thread(target=self.run_stage, args=(self.serialize, self.queues[1], self.queues[2]), daemon=True),
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def run_stage(self, stage, source, target):
+        """
+        Puts chunks produced by the stage into target queue, errors are passed to the next stage
+        """
+        chunks = stage(source)
+        try:
+            for chunk, size in chunks:
+                target.put(chunk, size)
+            target.put(END)
+        except PipelineCancelled:
+            pass
+        except BaseException as error:
+            target.put_error(error)
+        finally:
+            chunks.close()
+
+    def read(self, chunks):
+        """
+        Reader stage - compressed chunks downloaded or read from file
+        """
+        for chunk in chunks:
+            yield chunk, len(chunk)
+
+    def decode(self, chunks):
+        """
+        Decoder stage - decompressed lines grouped into chunks, lines loaded by previous runs are skipped
+        """
+        lines = itertools.islice(iter_gzip_lines(chunks, self.decompressor, self.stats), self.skip_lines, None)
+        yield from self.group(lines)
+
+    def serialize(self, chunks):
+        """
+        Transformer stage - rows ready for the writer, one row for each line
+        """
+        lines = (line for chunk in chunks for line in chunk)
+        yield from self.group(serialize_lines(lines, self.transform, self.transform_pool, self.unit,
+                                               self.skip_lines))
+
+    def group(self, items):
+        """
+        Yields lists of chunk_lines items with their size
+        """
+        chunk = []
+        size = 0
+        for item in items:
+            chunk.append(item)
+            size += len(item)
+            if len(chunk) >= self.chunk_lines:
+                yield chunk, size
+                chunk = []
+                size = 0
+        if chunk:
+            yield chunk, size
+
+    def rows(self):
+        """
+        Yields serialized row for each source line, empty string for empty lines
+        """
+        for chunk in self.queues[-1]:
+            yield from chunk
+
+    def close(self):
+        """
+        Stops stages which did not finish and waits for their threads
+        """
+        for queue in self.queues:
+            queue.cancel()
+        for thread in self.threads:
+            thread.join()
+        waits = ', '.join(f"{queue.name} {queue.waits}" for queue in self.queues)
+        print(f"  {datetime.now()}: pipeline backpressure waits per queue: {waits}")
@@ -0,0 +1,159 @@
+"""
+Background download of Github archive hourly files so that the next hours
+are downloaded while the current hour is loaded into the database
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import requests
+from gharchive_common import timestamped_filename
+
+# size assumed for download whose size is not known before it starts, until size of another file is known
+DEFAULT_FILE_SIZE = 100 * 1024 * 1024
+
+
+def check_length(req, size):
+    """
+    Raises EOFError if fewer bytes than announced by Content-Length header of the response were received
+    """
+    expected = req.headers.get('Content-Length')
+    if expected and expected.isdigit() and 'Content-Encoding' not in req.headers and size != int(expected):
+        raise EOFError(f"download of {req.url} is incomplete, received {size} of {expected} bytes")
+
+
+def download_file(url, local_filename, chunk_size=1024 * 1024, timeout=300):
+    """
+    Downloads url into local file, raises requests.exceptions.HTTPError if file is not available
+    and EOFError if the download is incomplete
+    """
+    size = 0
+    with requests.get(url, stream=True, timeout=timeout) as req:
+        req.raise_for_status()
+        with open(local_filename, 'wb') as file:
+            for chunk in req.iter_content(chunk_size=chunk_size):
+                file.write(chunk)
+                size += len(chunk)
+        check_length(req, size)
+    return local_filename
+
+
+def remote_size(url, timeout=30):
+    """
+    Returns size of remote file from Content-Length header, 0 if it is not known
+    """
+    try:
+        with requests.head(url, timeout=timeout, allow_redirects=True) as req:
+            return int(req.headers.get('Content-Length', 0)) if req.ok else 0
+    except (requests.exceptions.RequestException, ValueError):
+        return 0
+
+
+def temporary_filename(url, directory='/tmp'):
+    """
+    Returns unique local file name for url - randomized to avoid conflicts
+    """
+    return timestamped_filename(os.path.join(directory, url.split('/')[-1]))
+
+
+class HourPrefetcher:
+    """
+    Downloads files ahead of the hour which is currently loaded
+
+    At most depth files are downloaded concurrently ahead of the current one.
+    New downloads are not started while files not yet loaded take more than
+    disk_budget bytes. Files which are still downloaded count with their expected
+    size (Content-Length, or size of the largest known file when it is not sent),
+    so the budget can be exceeded by at most one file, unless the expected size
+    is too low.
+    If cache is set, files are fetched through the cache and kept on close,
+    files waiting for load and the file being loaded are pinned against eviction.
+    """
+
+    def __init__(self, urls, depth, disk_budget, directory='/tmp', debug=False, cache=None):
+        self.urls = urls
+        self.cache = cache
+        self.depth = depth
+        self.disk_budget = disk_budget
+        self.directory = directory
+        self.debug = debug
+        self.executor = ThreadPoolExecutor(max_workers=max(depth, 1))
+        self.futures = []
+        self.filenames = []
+        self.sizes = []
+
+    def expected_size(self, url, filename):
+        """
+        Returns expected size of file downloaded from url into filename
+        """
+        if self.cache and os.path.exists(filename):
+            return os.path.getsize(filename)
+        return remote_size(url) or max(self.sizes, default=DEFAULT_FILE_SIZE)
+
+    def disk_bytes(self, index):
+        """
+        Returns size of file index on disk, including partial download into the cache
+        """
+        filename = self.filenames[index]
+        size = os.path.getsize(filename) if os.path.exists(filename) else 0
+        if self.cache:
+            size += self.cache.partial_bytes(self.urls[index])
+        return size
+
+    def pending_bytes(self, index):
+        """
+        Returns size of downloaded files from index onwards, files still downloaded count with expected size
+        """
+        pending = 0
+        for position in range(index, len(self.filenames)):
+            if self.futures[position].done():
+                pending += self.disk_bytes(position)
+            else:
+                pending += max(self.disk_bytes(position), self.sizes[position])
+        return pending
+
+    def schedule(self, index):
+        """
+        Starts download of file index and of next files within depth and disk budget
+        """
+        last_index = min(index + self.depth, len(self.urls) - 1)
+        while len(self.futures) <= last_index:
+            next_index = len(self.futures)
+            if next_index > index and self.pending_bytes(index) >= self.disk_budget:
+                print(f"  {datetime.now()}: prefetch paused, disk budget {self.disk_budget} reached") if self.debug else None
+                break
+            url = self.urls[next_index]
+            filename = self.cache.path(url) if self.cache else temporary_filename(url, self.directory)
+            self.sizes.append(self.expected_size(url, filename))
+            self.filenames.append(filename)
+            if self.cache:
+                self.cache.pin(filename)
+                self.futures.append(self.executor.submit(self.cache.fetch, url))
+                continue
+            print(f"  {datetime.now()}: prefetching {url} into {filename}") if self.debug else None
+            self.futures.append(self.executor.submit(download_file, url, filename))
+
+    def get(self, index):
+        """
+        Returns future with local file name of file index and keeps prefetching next files
+        """
+        self.schedule(index)
+        if self.cache:
+            # files before index were loaded already
+            for filename in self.filenames[:index]:
+                self.cache.unpin(filename)
+        return self.futures[index]
+
+    def close(self):
+        """
+        Stops pending downloads and removes files which were not loaded
+        """
+        for future in self.futures:
+            future.cancel()
+        self.executor.shutdown(wait=True)
+        if self.cache:
+            for filename in self.filenames:
+                self.cache.unpin(filename)
+            return
+        for filename in self.filenames:
+            if os.path.exists(filename):
+                os.remove(filename)
@@ -0,0 +1,227 @@
+"""
+Helpers for reading Github archive hourly files as a stream of JSON lines
+without storing the whole file on the local disk first
+"""
+import os
+import time
+import zlib
+from contextlib import contextmanager
+from datetime import datetime
+import requests
+from gharchive_prefetch import check_length, download_file, temporary_filename
+
+try:
+    from isal import isal_zlib
+except ImportError:
+    isal_zlib = None
+
+try:
+    from zlib_ng import zlib_ng
+except ImportError:
+    zlib_ng = None
+
+# installed zlib compatible decompression backends, fastest first
+DECOMPRESSORS = {name: module for name, module in (('isal', isal_zlib), ('zlib_ng', zlib_ng), ('zlib', zlib))
+                 if module is not None}
+
+
+def decompressor_backend(name='auto'):
+    """
+    Returns name and zlib compatible module of decompression backend, 'auto' selects the fastest installed one
+    """
+    if name in (None, 'auto'):
+        name = next(iter(DECOMPRESSORS))
+    if name not in DECOMPRESSORS:
+        raise ValueError(f"decompressor {name} is not installed, available: {', '.join(DECOMPRESSORS)}")
+    return name, DECOMPRESSORS[name]
+
+
+def iter_gzip_lines(chunks, decompressor='auto', stats=None):
+    """
+    Decompresses gzip chunks incrementally and yields complete lines
+    Raises EOFError if the data end before the end of the last gzip member, so truncated file is never
+    loaded partially and its unfinished last line is never yielded
+    Backend name, decompressed size and time spent in decompression are stored into stats if it is set
+    """
+    name, module = decompressor_backend(decompressor)
+    # 16 + MAX_WBITS tells zlib to expect gzip header and trailer
+    decompressobj = module.decompressobj(16 + module.MAX_WBITS)
+    decompressed_bytes = 0
+    decompress_seconds = 0.0
+    pending = b''
+    try:
+        for chunk in chunks:
+            decompress_start = time.perf_counter()
+            data = decompressobj.decompress(chunk)
+            # gzip file can consist of several concatenated members
+            while decompressobj.eof and decompressobj.unused_data:
+                unused_data = decompressobj.unused_data
+                decompressobj = module.decompressobj(16 + module.MAX_WBITS)
+                data += decompressobj.decompress(unused_data)
+            decompress_seconds += time.perf_counter() - decompress_start
+            if not data:
+                continue
+            decompressed_bytes += len(data)
+            # whole block is split at once, only the line continuing from previous block is joined
+            lines = data.split(b'\n')
+            if pending:
+                lines[0] = pending + lines[0]
+            pending = lines.pop()
+            yield from lines
+
+        pending += decompressobj.flush()
+        if not decompressobj.eof:
+            raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+        if pending:
+            yield from pending.split(b'\n')
+    finally:
+        if stats is not None:
+            stats.update(decompressor=name, decompressed_bytes=decompressed_bytes,
+                         decompress_seconds=decompress_seconds)
+
+
+def stream_archive_chunks(url, stats=None, tee=None, chunk_size=1024 * 1024, timeout=300):
+    """
+    Downloads gzip file from url and yields compressed chunks while the download is running
+    Number of downloaded compressed bytes is stored into stats['compressed_bytes'] if stats is set
+    Raises EOFError if fewer bytes than announced by Content-Length were received
+    Compressed data are also written into tee file if it is set
+    """
+    stats = stats if stats is not None else {}
+    with requests.get(url, stream=True, timeout=timeout) as req:
+        req.raise_for_status()
+        yield from count_bytes(req.iter_content(chunk_size=chunk_size), stats, tee)
+        # incomplete download must not be stored into cache
+        check_length(req, stats['compressed_bytes'])
+    stats['complete'] = True
+
+
+def read_file_chunks(filename, chunk_size=1024 * 1024):
+    """
+    Yields chunks of local file
+    """
+    with open(filename, 'rb') as file:
+        yield from iter(lambda: file.read(chunk_size), b'')
+
+
+def count_bytes(chunks, stats, tee=None):
+    """
+    Passes chunks through, counts their total size and copies them into tee file
+    """
+    if stats is not None:
+        stats['compressed_bytes'] = 0
+    for chunk in chunks:
+        if stats is not None:
+            stats['compressed_bytes'] += len(chunk)
+        if tee is not None:
+            tee.write(chunk)
+        yield chunk
+
+
+@contextmanager
+def open_archive_chunks(url, stream=False, prefetched=None, cache=None, stats=None):
+    """
+    Yields iterator of compressed chunks of the hourly file from url
+
+    File is taken from prefetched future or from cache if they are set,
+    otherwise it is downloaded into /tmp, or streamed when stream is set.
+    Streamed data are stored into cache when the whole file was downloaded and
+    read without error.
+    Temporary files are deleted on exit.
+    """
+    stats = stats if stats is not None else {}
+    local_filename = None
+    temporary = False
+    tee = None
+    tee_filename = None
+    loaded = False
+
+    if stream and cache:
+        local_filename = cache.get(url)
+    if local_filename:
+        pass
+    elif stream:
+        print(f"  {datetime.now()}: streaming {url}")
+        if cache:
+            tee_filename = cache.partial_filename(url)
+            tee = open(tee_filename, 'wb')
+    elif prefetched is not None:
+        print(f"  {datetime.now()}: waiting for prefetched {url}")
+        local_filename = prefetched.result()
+        temporary = cache is None
+    elif cache:
+        local_filename = cache.fetch(url)
+    else:
+        # Download the file - randomize the file name to avoid conflicts
+        local_filename = temporary_filename(url)
+        print(f"  {datetime.now()}: downloading {local_filename} ")
+        temporary = True
+        download_file(url, local_filename)
+
+    try:
+        if local_filename:
+            print(f"  {datetime.now()}: downloaded")
+            stats['compressed_bytes'] = os.stat(local_filename).st_size
+            print(f"  {datetime.now()}: file size: {stats['compressed_bytes']}")
+            stats['source'] = local_filename
+            chunks = read_file_chunks(local_filename)
+        else:
+            stats['source'] = url
+            chunks = stream_archive_chunks(url, stats, tee)
+        try:
+            yield chunks
+        finally:
+            chunks.close()
+        loaded = True
+        if not local_filename:
+            print(f"  {datetime.now()}: streamed compressed size: {stats.get('compressed_bytes', 0)}")
+    finally:
+        if tee is not None:
+            tee.close()
+            if loaded and stats.get('complete'):
+                cache.put(url, tee_filename)
+            else:
+                os.remove(tee_filename)
+        if temporary:
+            # Delete the file
+            os.remove(local_filename)
+
+
+def read_archive_bytes(url, cache=None, stats=None):
+    """
+    Returns compressed content of the hourly file from url, nothing is written to local disk
+    File is read from cache if it is cached there, otherwise it is downloaded into memory
+    """
+    stats = stats if stats is not None else {}
+    local_filename = cache.get(url) if cache else None
+    if local_filename:
+        stats['source'] = local_filename
+        with open(local_filename, 'rb') as file:
+            data = file.read()
+    else:
+        print(f"  {datetime.now()}: downloading {url} into memory")
+        stats['source'] = url
+        data = b''.join(stream_archive_chunks(url, stats))
+    stats['compressed_bytes'] = len(data)
+    print(f"  {datetime.now()}: file size: {stats['compressed_bytes']}")
+    return data
+
+
+@contextmanager
+def open_archive_file(url, prefetched=None, cache=None, stats=None):
+    """
+    Yields name of local copy of the hourly file from url, see open_archive_chunks
+    """
+    stats = stats if stats is not None else {}
+    # without streaming chunks are read from the local file, which is the source
+    with open_archive_chunks(url, False, prefetched, cache, stats):
+        yield stats['source']
+
+
+@contextmanager
+def open_archive_lines(url, stream=False, prefetched=None, cache=None, stats=None, decompressor='auto'):
+    """
+    Yields decompressed lines of the hourly file from url, see open_archive_chunks
+    """
+    with open_archive_chunks(url, stream, prefetched, cache, stats) as chunks:
+        yield iter_gzip_lines(chunks, decompressor, stats)
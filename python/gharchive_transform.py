@@ -0,0 +1,166 @@
+"""
+Parsing and transformation of Github archive lines in worker processes
+
+JSON decode, transformation and encode run in separate processes, so the
+loader process is not limited by the GIL to one core. Chunks of raw lines are
+sent to workers as one bytes object and serialized rows come back in shared
+memory block, only its name and size are pickled.
+"""
+import json
+import multiprocessing
+from collections import deque
+from operator import itemgetter
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing import shared_memory
+from gharchive_events import loads, serialize_line
+
+
+def transform_chunk(chunk, transform=None, unit=None, first_line=0):
+    """
+    Serializes newline separated raw lines into shared memory, returns name and size of the block
+    Each line gives one row, empty lines give empty rows, so rows match source line numbers
+    Unit (hour) and index of the first line of the chunk give positions of lines to the transform
+    """
+    rows = [serialize_line(line, transform, (unit, index)) if line.strip() else ''
+            for index, line in enumerate(chunk.split(b'\n'), first_line)]
+    data = '\n'.join(rows).encode('utf-8')
+    # shared memory block can not be empty
+    memory = shared_memory.SharedMemory(create=True, size=max(len(data), 1))
+    memory.buf[:len(data)] = data
+    memory.close()
+    return memory.name, len(data)
+
+
+def read_rows(name, size):
+    """
+    Returns rows stored in shared memory block and releases the block
+    """
+    memory = shared_memory.SharedMemory(name=name)
+    try:
+        data = bytes(memory.buf[:size])
+    finally:
+        memory.close()
+        memory.unlink()
+    return data.decode('utf-8').split('\n')
+
+
+def serialize_lines(lines, transform=None, pool=None, unit=None, first_line=0):
+    """
+    Yields serialized row for each line, empty string for empty lines
+    Lines are processed by worker processes of the pool if it is set, pool uses its own transform
+    Unit (hour) and index of the first line in the file give positions of lines to the transform
+    """
+    if pool:
+        return pool.map(lines, unit, first_line)
+    return (serialize_line(line, transform, (unit, index)) if line.strip() else ''
+            for index, line in enumerate(lines, first_line))
+
+
+def row_sort_key(row, paths):
+    """
+    Returns sort key of serialized row, missing values sort first, numbers before strings
+    """
+    event = loads(row)
+    key = []
+    for path in paths:
+        value = event
+        for name in path:
+            value = value.get(name) if isinstance(value, dict) else None
+        if value is None:
+            key.append((0, 0, 0))
+        elif isinstance(value, (int, float)):
+            key.append((1, 0, value))
+        elif isinstance(value, str):
+            key.append((1, 1, value))
+        else:
+            key.append((1, 2, json.dumps(value, sort_keys=True)))
+    return key
+
+
+def sort_rows(rows, sort_paths, window=0):
+    """
+    Yields non-empty rows sorted by dotted paths in windows of window rows, whole input is one window if window is 0
+    Rows with equal keys keep their order
+    """
+    paths = [tuple(path.split('.')) for path in sort_paths]
+    buffer = []
+    for row in rows:
+        if not row:
+            continue
+        buffer.append((row_sort_key(row, paths), row))
+        if window and len(buffer) >= window:
+            buffer.sort(key=itemgetter(0))
+            yield from (row for _, row in buffer)
+            buffer = []
+    buffer.sort(key=itemgetter(0))
+    yield from (row for _, row in buffer)
+
+
+class TransformPool:
+    """
+    Process pool serializing lines of hourly files
+
+    At most two chunks per worker are in flight, so the pool does not read the
+    whole file ahead of the writer. With ordered set rows are returned in the
+    order of source lines, otherwise chunks are returned as they are finished.
+    """
+
+    def __init__(self, workers, transform=None, chunk_lines=10000, ordered=True):
+        self.workers = workers
+        self.transform = transform
+        self.chunk_lines = chunk_lines
+        self.ordered = ordered
+        self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def chunks(self, lines, first_line=0):
+        """
+        Yields chunks of chunk_lines lines joined by newline with index of their first line
+        """
+        chunk = []
+        for line in lines:
+            chunk.append(line.rstrip(b'\r\n'))
+            if len(chunk) >= self.chunk_lines:
+                yield b'\n'.join(chunk), first_line
+                first_line += len(chunk)
+                chunk = []
+        if chunk:
+            yield b'\n'.join(chunk), first_line
+
+    def map(self, lines, unit=None, first_line=0):
+        """
+        Yields serialized row for each line, empty string for empty lines
+        """
+        pending = deque()
+        chunks = self.chunks(lines, first_line)
+        try:
+            for chunk, chunk_first_line in chunks:
+                pending.append(self.executor.submit(transform_chunk, chunk, self.transform, unit, chunk_first_line))
+                if len(pending) >= 2 * self.workers:
+                    yield from read_rows(*self.next_done(pending).result())
+            while pending:
+                yield from read_rows(*self.next_done(pending).result())
+        finally:
+            # release blocks of chunks which were not read when the load was interrupted
+            for future in pending:
+                if not future.cancel():
+                    try:
+                        read_rows(*future.result())
+                    except Exception:
+                        pass
+
+    def next_done(self, pending):
+        """
+        Removes and returns next future to read, the oldest one when order is preserved
+        """
+        if self.ordered:
+            return pending.popleft()
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        future = next(iter(done))
+        pending.remove(future)
+        return future
+
+    def close(self):
+        """
+        Stops worker processes
+        """
+        self.executor.shutdown(wait=True, cancel_futures=True)
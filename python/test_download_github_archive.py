@@ -0,0 +1,78 @@
+import os
+import shutil
+import tempfile
+import unittest
+from types import SimpleNamespace
+from download_github_archive import build_deferred_indexes, drop_deferred_indexes, psycopg2
+
+# libpq connection string of test database, PostgreSQL tests are skipped when it is not set
+TEST_DSN = os.environ.get('GHARCHIVE_TEST_DSN')
+
+
+@unittest.skipIf(not TEST_DSN, 'GHARCHIVE_TEST_DSN is not set')
+class TestDeferredIndexes(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.conn = psycopg2.connect(TEST_DSN)
+        self.cur = self.conn.cursor()
+        self.cur.execute("DROP TABLE IF EXISTS test_events CASCADE")
+        self.cur.execute("CREATE TABLE test_events (id bigserial, jsonb_data jsonb)")
+        self.cur.execute("CREATE INDEX test_events_gin ON test_events USING gin (jsonb_data)")
+        self.conn.commit()
+
+    def tearDown(self):
+        self.conn.rollback()
+        self.cur.execute("DROP TABLE IF EXISTS test_events CASCADE")
+        self.conn.commit()
+        self.conn.close()
+        shutil.rmtree(self.directory)
+
+    def args(self, route_by_type):
+        return SimpleNamespace(table_name='test_events', route_by_type=route_by_type, index_build_workers=0,
+                               maintenance_work_mem='64MB', runtime_file=os.path.join(self.directory, 'runtime.csv'))
+
+    def index_count(self, table):
+        self.cur.execute("SELECT count(*) FROM pg_index WHERE indrelid = %s::regclass AND NOT indisunique",
+                         (table, ))
+        return self.cur.fetchone()[0]
+
+    def test_inheritance_route_tables(self):
+        args = self.args('table')
+        self.cur.execute("CREATE TABLE test_events_push (LIKE test_events INCLUDING ALL) INHERITS (test_events)")
+        self.conn.commit()
+        index_defs = drop_deferred_indexes(self.conn, self.cur, args)
+        self.assertEqual(self.index_count('test_events_push'), 0)
+        # route table created while indexes are deferred
+        self.cur.execute("CREATE TABLE test_events_fork (LIKE test_events INCLUDING ALL) INHERITS (test_events)")
+        self.conn.commit()
+        build_deferred_indexes(self.conn, self.cur, args, index_defs)
+        for table in ('test_events', 'test_events_push', 'test_events_fork'):
+            self.assertEqual(self.index_count(table), 1)
+        self.assertFalse(os.path.exists(f"{args.runtime_file}.deferred_indexes.sql"))
+
+    def test_index_of_route_table_is_kept(self):
+        args = self.args('table')
+        self.cur.execute("CREATE TABLE test_events_push (LIKE test_events INCLUDING ALL) INHERITS (test_events)")
+        self.cur.execute("CREATE INDEX ON test_events_push ((jsonb_data->>'type'))")
+        self.conn.commit()
+        drop_deferred_indexes(self.conn, self.cur, args)
+        self.assertEqual(self.index_count('test_events_push'), 1)
+
+    def test_partitions(self):
+        args = self.args('partition')
+        self.cur.execute("DROP TABLE test_events")
+        self.cur.execute("CREATE TABLE test_events (id bigserial, jsonb_data jsonb) "
+                         "PARTITION BY LIST ((jsonb_data->>'type'))")
+        self.cur.execute("CREATE TABLE test_events_push PARTITION OF test_events FOR VALUES IN ('PushEvent')")
+        self.cur.execute("CREATE INDEX test_events_gin ON test_events USING gin (jsonb_data)")
+        self.conn.commit()
+        index_defs = drop_deferred_indexes(self.conn, self.cur, args)
+        self.cur.execute("CREATE TABLE test_events_fork PARTITION OF test_events FOR VALUES IN ('ForkEvent')")
+        self.conn.commit()
+        build_deferred_indexes(self.conn, self.cur, args, index_defs)
+        for table in ('test_events_push', 'test_events_fork'):
+            self.assertEqual(self.index_count(table), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
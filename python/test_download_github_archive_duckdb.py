@@ -0,0 +1,88 @@
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from types import SimpleNamespace
+import download_github_archive_duckdb
+from download_github_archive_duckdb import ArrowBatchWriter, duckdb, insert_memory_json, insert_native_json, pyarrow
+
+
+def event(event_id, event_type, repo_name):
+    return {'id': str(event_id), 'type': event_type, 'repo': {'id': event_id, 'name': repo_name}}
+
+
+class TestInsertNativeJson(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, '2023-01-01-0.json.gz')
+        events = [event(1, 'PushEvent', 'a/b'), event(2, 'PushEvent', 'c/d'), event(3, 'IssuesEvent', 'a/b')]
+        with gzip.open(self.filename, 'wt') as file:
+            file.write(''.join(json.dumps(item) + '\n' for item in events))
+        self.conn = duckdb.connect()
+        self.cur = self.conn.cursor()
+        self.cur.execute("CREATE SEQUENCE json_id START WITH 1 INCREMENT BY 1")
+        self.cur.execute("CREATE TABLE events (id INTEGER DEFAULT nextval('json_id'), json_data JSON, "
+                         "data_source VARCHAR)")
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.directory)
+
+    def load(self, include_types=None, include_repos=None):
+        args = SimpleNamespace(table_name='events', include_types=include_types, include_repos=include_repos,
+                               debug=False)
+        rows = insert_native_json(self.cur, self.filename, args)
+        self.cur.execute("SELECT json_data->>'id' FROM events ORDER BY 1")
+        ids = [row[0] for row in self.cur.fetchall()]
+        self.assertEqual(rows, len(ids))
+        return ids
+
+    def test_without_filters(self):
+        self.assertEqual(self.load(), ['1', '2', '3'])
+
+    def test_type_filter(self):
+        self.assertEqual(self.load(['PushEvent']), ['1', '2'])
+
+    def test_type_and_repo_filters(self):
+        self.assertEqual(self.load(['PushEvent'], ['a/b']), ['1'])
+
+    @unittest.skipIf(download_github_archive_duckdb.ModifiedMemoryFileSystem is None, 'fsspec is not installed')
+    def test_memory_file(self):
+        memory_fs = download_github_archive_duckdb.ArchiveMemoryFileSystem()
+        self.conn.register_filesystem(memory_fs)
+        with open(self.filename, 'rb') as file:
+            data = file.read()
+        args = SimpleNamespace(table_name='events', include_types=['IssuesEvent'], include_repos=None, debug=False)
+        self.assertEqual(insert_memory_json(self.cur, memory_fs, data, '2023-01-01-0', args), 1)
+        self.assertFalse(memory_fs.exists('gharchive://2023-01-01-0.json.gz'))
+
+
+@unittest.skipIf(pyarrow is None, 'pyarrow is not installed')
+class TestArrowBatchWriter(unittest.TestCase):
+    def setUp(self):
+        self.conn = duckdb.connect()
+        self.cur = self.conn.cursor()
+        self.cur.execute("CREATE SEQUENCE json_id START WITH 1 INCREMENT BY 1")
+        self.cur.execute("CREATE TABLE events (id INTEGER DEFAULT nextval('json_id'), json_data JSON, "
+                         "data_source VARCHAR)")
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_ids_and_invalid_rows(self):
+        self.cur.execute("INSERT INTO events (json_data) VALUES ('{\"id\": \"0\"}')")
+        writer = ArrowBatchWriter(self.cur, 'events', 2)
+        for row in ['{"id": "1"}', '{"id": "2"}', 'not json', '{"id": "3"}', '{"id": "4"}']:
+            writer.write(row)
+        writer.close()
+        self.assertEqual(writer.errors, 1)
+        self.cur.execute("SELECT id, json_data->>'id' FROM events ORDER BY id")
+        rows = self.cur.fetchall()
+        self.assertEqual([row[1] for row in rows], ['0', '1', '2', '3', '4'])
+        self.assertEqual(len({row[0] for row in rows}), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
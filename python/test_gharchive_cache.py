@@ -0,0 +1,69 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+import gharchive_cache
+from gharchive_cache import CHECKSUM_SUFFIX, ArchiveCache
+
+URL = 'https://data.gharchive.org/2023-01-01-0.json.gz'
+
+
+class TestArchiveCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = ArchiveCache(self.directory, 0)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def download(self, content, url=URL):
+        filename = self.cache.partial_filename(url)
+        with open(filename, 'wb') as file:
+            file.write(content)
+        return filename
+
+    def test_put_and_get(self):
+        cached_filename = self.cache.put(URL, self.download(b'data'))
+        self.assertEqual(cached_filename, self.cache.path(URL))
+        self.assertTrue(os.path.exists(cached_filename + CHECKSUM_SUFFIX))
+        self.assertEqual(self.cache.get(URL), cached_filename)
+        self.assertEqual(sorted(os.listdir(self.directory)), ['2023-01-01-0.json.gz', '2023-01-01-0.json.gz.sha256'])
+        self.assertEqual(self.cache.partial_bytes(URL), 0)
+
+    def test_damaged_file_is_removed(self):
+        cached_filename = self.cache.put(URL, self.download(b'data'))
+        with open(cached_filename, 'wb') as file:
+            file.write(b'atad')
+        self.assertIsNone(self.cache.get(URL))
+        self.assertFalse(os.path.exists(cached_filename))
+        self.assertFalse(os.path.exists(cached_filename + CHECKSUM_SUFFIX))
+
+    def test_failed_download_is_not_cached(self):
+        def download_file(url, filename):
+            with open(filename, 'wb') as file:
+                file.write(b'da')
+            raise EOFError('incomplete')
+
+        with patch.object(gharchive_cache, 'download_file', download_file):
+            with self.assertRaises(EOFError):
+                self.cache.fetch(URL)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_evict_keeps_pinned_files(self):
+        self.cache.max_size = 10
+        other_url = URL.replace('-0.', '-1.')
+        pinned_filename = self.cache.put(URL, self.download(b'x' * 8))
+        self.cache.pin(pinned_filename)
+        os.utime(pinned_filename, (0, 0))
+        self.cache.put(other_url, self.download(b'y' * 8, other_url))
+        self.assertTrue(os.path.exists(pinned_filename))
+        self.assertTrue(os.path.exists(self.cache.path(other_url)))
+        self.cache.unpin(pinned_filename)
+        self.cache.evict()
+        self.assertFalse(os.path.exists(pinned_filename))
+        self.assertTrue(os.path.exists(self.cache.path(other_url)))
+
+
+if __name__ == '__main__':
+    unittest.main()
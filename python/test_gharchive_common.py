@@ -0,0 +1,42 @@
+import os
+import shutil
+import tempfile
+import unittest
+from gharchive_common import prepare_runtime_file
+
+HEADER = 'file_name,rows\n'
+
+
+class TestRuntimeFile(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.runtime_file = os.path.join(self.directory, 'runtime.csv')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read(self):
+        with open(self.runtime_file) as file:
+            return file.read()
+
+    def test_new_file_gets_header(self):
+        self.assertTrue(prepare_runtime_file(self.runtime_file, HEADER))
+        self.assertEqual(self.read(), HEADER)
+
+    def test_rows_are_appended_to_same_header(self):
+        with open(self.runtime_file, 'w') as file:
+            file.write(HEADER + 'a,1\n')
+        self.assertTrue(prepare_runtime_file(self.runtime_file, HEADER))
+        self.assertEqual(self.read(), HEADER + 'a,1\n')
+
+    def test_different_header(self):
+        with open(self.runtime_file, 'w') as file:
+            file.write('file_name\na\n')
+        self.assertFalse(prepare_runtime_file(self.runtime_file, HEADER))
+        self.assertEqual(self.read(), 'file_name\na\n')
+        self.assertTrue(prepare_runtime_file(self.runtime_file, HEADER, rewrite=True))
+        self.assertEqual(self.read(), HEADER)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import copy
+import json
+import os
+import unittest
+from gharchive_compact import compact_event, expand_event, expand_function_sql
+
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None
+
+# libpq connection string of test database, PostgreSQL tests are skipped when it is not set
+TEST_DSN = os.environ.get('GHARCHIVE_TEST_DSN')
+
+API = 'https://api.github.com'
+
+EVENTS = [
+    {'id': '1', 'type': 'IssueCommentEvent',
+     'actor': {'id': 7, 'login': 'octo', 'url': f'{API}/users/octo',
+               'avatar_url': 'https://avatars.githubusercontent.com/u/7?'},
+     'repo': {'id': 3, 'name': 'octo/repo', 'url': f'{API}/repos/octo/repo'},
+     'payload': {'issue': {'number': 5, 'url': f'{API}/repos/octo/repo/issues/5',
+                           'html_url': 'https://github.com/octo/repo/issues/5',
+                           'user': {'id': 8, 'login': 'cat', 'url': f'{API}/users/cat', 'html_url': 'custom'},
+                           'labels': [{'id': 1, 'login': 'x', 'url': f'{API}/users/x'}]},
+                 'comment': {'id': 9, 'url': f'{API}/repos/octo/repo/issues/comments/9',
+                             'issue_url': f'{API}/repos/octo/repo/issues/5'}}},
+    # keys which look like the compaction marker
+    {'id': '2', 'type': 'PushEvent', 'actor': {'id': 7, 'login': 'a', '_u': 3},
+     'payload': {'x': {'_u': 3, 'login': 'a'}, '__u': {'_u': 'text', 'url': f'{API}/users/b', 'login': 'b'}}},
+]
+
+
+class TestCompaction(unittest.TestCase):
+    def test_url_fields_are_removed(self):
+        compacted = compact_event(copy.deepcopy(EVENTS[0]))
+        self.assertNotIn('url', compacted['actor'])
+        self.assertEqual(compacted['payload']['issue']['user']['html_url'], 'custom')
+        self.assertLess(len(json.dumps(compacted)), len(json.dumps(EVENTS[0])))
+
+    def test_round_trip(self):
+        for event in EVENTS:
+            self.assertEqual(expand_event(compact_event(copy.deepcopy(event))), event)
+
+    def test_marker_keys_round_trip(self):
+        compacted = compact_event(copy.deepcopy(EVENTS[1]))
+        self.assertEqual(compacted['payload']['x'], {'__u': 3, 'login': 'a'})
+        self.assertEqual(expand_event(compacted)['payload']['x'], {'_u': 3, 'login': 'a'})
+
+
+@unittest.skipIf(psycopg2 is None or not TEST_DSN, 'GHARCHIVE_TEST_DSN is not set')
+class TestExpandFunction(unittest.TestCase):
+    def setUp(self):
+        self.conn = psycopg2.connect(TEST_DSN)
+        self.cur = self.conn.cursor()
+        self.cur.execute(expand_function_sql('pg_temp'))
+
+    def tearDown(self):
+        self.conn.rollback()
+        self.conn.close()
+
+    def test_round_trip(self):
+        for event in EVENTS:
+            compacted = compact_event(copy.deepcopy(event))
+            self.cur.execute("SELECT pg_temp.gharchive_expand(%s::jsonb)", (json.dumps(compacted), ))
+            self.assertEqual(self.cur.fetchone()[0], event)
+
+
+if __name__ == '__main__':
+    unittest.main()
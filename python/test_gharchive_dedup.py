@@ -0,0 +1,59 @@
+import os
+import shutil
+import tempfile
+import unittest
+from gharchive_dedup import BloomFilter, EventIdFilter, event_id
+
+
+class TestEventId(unittest.TestCase):
+    def test_event_id(self):
+        self.assertEqual(event_id('{"id":"123","type":"PushEvent"}'), '123')
+        self.assertEqual(event_id('{"type":"PushEvent","id":456}'), '456')
+        self.assertIsNone(event_id('{"type":"PushEvent"}'))
+
+
+class TestBloomFilter(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'ids.bloom')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_add_and_contains(self):
+        bloom = BloomFilter(1000, 0.001)
+        self.assertFalse(bloom.add('1'))
+        self.assertTrue(bloom.add('1'))
+        self.assertIn('1', bloom)
+        self.assertEqual(bloom.count, 1)
+        false_positives = sum(str(key) in bloom for key in range(2, 1002))
+        self.assertLess(false_positives, 10)
+
+    def test_save_and_load(self):
+        bloom = BloomFilter(1000, 0.001)
+        for key in range(100):
+            bloom.add(str(key))
+        bloom.save(self.filename)
+        self.assertEqual(os.listdir(self.directory), ['ids.bloom'])
+        loaded = BloomFilter.load(self.filename)
+        self.assertEqual((loaded.size, loaded.hashes, loaded.count), (bloom.size, bloom.hashes, bloom.count))
+        self.assertTrue(all(str(key) in loaded for key in range(100)))
+
+    def test_truncated_file(self):
+        BloomFilter(1000, 0.001).save(self.filename)
+        with open(self.filename, 'r+b') as file:
+            file.truncate(os.path.getsize(self.filename) - 1)
+        with self.assertRaises(ValueError):
+            BloomFilter.load(self.filename)
+
+    def test_filter_is_saved_every_save_hours(self):
+        ids = EventIdFilter(self.filename, 1000, 0.001, save_hours=2)
+        self.assertFalse(ids.suspected('{"id":"1"}'))
+        ids.hour_loaded()
+        self.assertFalse(os.path.exists(self.filename))
+        ids.hour_loaded()
+        self.assertTrue(EventIdFilter(self.filename, 1000, 0.001).suspected('{"id":"1"}'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+import json
+import unittest
+import gharchive_events
+from gharchive_events import dumps, event_type, sanitize, serialize_line
+
+
+class TestSanitize(unittest.TestCase):
+    def test_line_end_is_removed(self):
+        self.assertEqual(sanitize(b'{"a":"b"}\r\n'), '{"a":"b"}')
+
+    def test_nul_escape_is_removed(self):
+        self.assertEqual(sanitize(b'{"a":"x\\u0000y"}'), '{"a":"xy"}')
+
+    def test_escaped_backslash_before_u0000_is_kept(self):
+        # \\u0000 is backslash followed by text u0000, not NUL character
+        self.assertEqual(sanitize(b'{"a":"x\\\\u0000y"}'), '{"a":"x\\\\u0000y"}')
+        self.assertEqual(sanitize(b'{"a":"x\\\\\\u0000y"}'), '{"a":"x\\\\y"}')
+
+    def test_backticks_are_replaced(self):
+        self.assertEqual(sanitize(b'{"a":"`b`"}'), '{"a":"\'b\'"}')
+
+    def test_utf8(self):
+        self.assertEqual(json.loads(sanitize('{"a":"žluť"}'.encode('utf-8'))), {'a': 'žluť'})
+
+
+class TestSerialize(unittest.TestCase):
+    def test_without_transform(self):
+        self.assertEqual(serialize_line(b'{"id":"1","type":"PushEvent"}\n'), '{"id":"1","type":"PushEvent"}')
+
+    def test_filtered_event(self):
+        self.assertEqual(serialize_line(b'{"id":"1"}', lambda event, position: None), '')
+
+    def test_event_type(self):
+        self.assertEqual(event_type('{"id":"1","type":"PushEvent"}'), 'PushEvent')
+        self.assertEqual(event_type('{"payload":{},"type":"IssuesEvent"}'), 'IssuesEvent')
+        self.assertIsNone(event_type('{"id":"1"}'))
+
+    def test_dumps_lone_surrogate(self):
+        orjson = gharchive_events.orjson
+        try:
+            for module in {orjson, None}:
+                gharchive_events.orjson = module
+                self.assertEqual(json.loads(dumps({'a': '\ud800', 'b': 'é'})), {'a': '\ud800', 'b': 'é'})
+        finally:
+            gharchive_events.orjson = orjson
+
+
+if __name__ == '__main__':
+    unittest.main()
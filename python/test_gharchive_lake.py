@@ -0,0 +1,76 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import gharchive_lake
+from gharchive_lake import LakeManifest, LakeWriter, compact_date
+
+try:
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+def event(event_id, event_type='PushEvent', minute=0, repo_id=1):
+    return json.dumps({'id': str(event_id), 'type': event_type, 'public': True,
+                       'created_at': f'2023-01-01T{minute // 60:02d}:{minute % 60:02d}:00Z',
+                       'actor': {'id': 5, 'login': 'a'}, 'repo': {'id': repo_id, 'name': 'x/y'},
+                       'payload': {'size': 1}})
+
+
+@unittest.skipIf(pyarrow is None, 'pyarrow is not installed')
+class TestLake(unittest.TestCase):
+    def setUp(self):
+        self.lake_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.lake_dir)
+
+    def write_hour(self, date_str, rows):
+        writer = LakeWriter(self.lake_dir, date_str)
+        for row in rows:
+            writer.write(row)
+        writer.close()
+        return writer
+
+    def read_ids(self):
+        ids = []
+        for directory, _, names in os.walk(self.lake_dir):
+            for name in names:
+                if name.endswith('.parquet'):
+                    ids += pyarrow.parquet.read_table(os.path.join(directory, name))['id'].to_pylist()
+        return sorted(ids)
+
+    def test_write_and_read_back(self):
+        writer = self.write_hour('2023-01-01-00', [event(1), event(2, 'IssuesEvent'), event(3)])
+        self.assertEqual(len(writer.files), 2)
+        table = pyarrow.parquet.read_table(writer.files[1])
+        self.assertEqual(table.schema, gharchive_lake.arrow_schema())
+        self.assertEqual(table['id'].to_pylist(), ['1', '3'])
+        self.assertEqual(table['public'].to_pylist(), [True, True])
+        self.assertEqual(json.loads(table['payload'][0].as_py()), {'size': 1})
+        self.assertEqual(sorted(LakeManifest(self.lake_dir).files()), sorted(
+            os.path.relpath(filename, self.lake_dir) for filename in writer.files))
+
+    def test_reload_after_compaction_replaces_hour(self):
+        self.write_hour('2023-01-01-00', [event(1), event(2)])
+        self.write_hour('2023-01-01-01', [event(3, minute=60)])
+        compact_date(self.lake_dir, '2023-01-01')
+        self.write_hour('2023-01-01-00', [event(1), event(2)])
+        compact_date(self.lake_dir, '2023-01-01')
+        self.assertEqual(self.read_ids(), ['1', '2', '3'])
+        self.assertEqual(sum(entry['rows'] for entry in LakeManifest(self.lake_dir).files().values()), 3)
+
+    def test_compaction_keeps_files_of_lake_without_manifest(self):
+        self.write_hour('2023-01-01-00', [event(1)])
+        self.write_hour('2023-01-02-00', [event(2)])
+        os.remove(os.path.join(self.lake_dir, gharchive_lake.MANIFEST_FILE))
+        compact_date(self.lake_dir, '2023-01-01')
+        self.assertEqual(sorted(LakeManifest(self.lake_dir).files()), [
+            os.path.join('date=2023-01-01', 'hour=all', 'type=PushEvent', '2023-01-01.parquet'),
+            os.path.join('date=2023-01-02', 'hour=00', 'type=PushEvent', '2023-01-02-00.parquet')])
+
+
+if __name__ == '__main__':
+    unittest.main()
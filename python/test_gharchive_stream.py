@@ -0,0 +1,44 @@
+import gzip
+import unittest
+from gharchive_stream import iter_gzip_lines
+
+
+def chunked(data, size=7):
+    return [data[start:start + size] for start in range(0, len(data), size)]
+
+
+class TestIterGzipLines(unittest.TestCase):
+    def setUp(self):
+        self.lines = [f'{{"n":{number}}}'.encode() for number in range(100)]
+        self.data = gzip.compress(b'\n'.join(self.lines) + b'\n')
+
+    def test_lines(self):
+        stats = {}
+        self.assertEqual([line for line in iter_gzip_lines(chunked(self.data), 'zlib', stats) if line], self.lines)
+        self.assertEqual(stats['decompressor'], 'zlib')
+        self.assertEqual(stats['decompressed_bytes'], sum(len(line) + 1 for line in self.lines))
+
+    def test_last_line_without_newline(self):
+        data = gzip.compress(b'\n'.join(self.lines))
+        self.assertEqual(list(iter_gzip_lines(chunked(data), 'zlib')), self.lines)
+
+    def test_multi_member_archive(self):
+        data = gzip.compress(b'\n'.join(self.lines[:50]) + b'\n') + gzip.compress(b'\n'.join(self.lines[50:]) + b'\n')
+        self.assertEqual([line for line in iter_gzip_lines(chunked(data), 'zlib') if line], self.lines)
+
+    def test_truncated_archive(self):
+        lines = []
+        with self.assertRaises(EOFError):
+            for line in iter_gzip_lines(chunked(self.data[:len(self.data) // 2]), 'zlib'):
+                lines.append(line)
+        # lines yielded before the error are complete lines
+        self.assertEqual(lines, self.lines[:len(lines)])
+
+    def test_truncated_trailer(self):
+        # all lines are decompressed but the gzip trailer with checksum is missing
+        with self.assertRaises(EOFError):
+            list(iter_gzip_lines(chunked(self.data[:-4]), 'zlib'))
+
+
+if __name__ == '__main__':
+    unittest.main()